@@ -34,30 +34,56 @@ messages from the WorkerBees.
 '''
 
 import optparse
+import numpy
 import os
 import re
 import random
+import signal
 import socket
 import sys
 import tempfile
-import cPickle
-import MySQLdb
 import time
+import traceback
 import warnings
+from functools import partial
 from datetime import datetime
-from threading import Thread
-from multiprocessing import Value, Queue
+from threading import Thread, Lock, Condition, Event, local, current_thread
+from multiprocessing import Value, Queue, Semaphore, cpu_count
 from multiprocessing.queues import Empty
-from collections import defaultdict
-from itertools import chain
+from collections import defaultdict, deque
+from itertools import chain, count, islice
 
 from apiary.tools.childprocess import ChildProcess
 from apiary.tools.debug import debug, traced_func, traced_method
-from apiary.tools.stats import Tally, Level, Series
+from apiary.tools.jobsindex import index_format, open_index, iter_index, iter_index_chunks, iter_pickle_index, iter_jobs, job_key, map_jobs_file, capture_end, CHUNK_SIZE
+from apiary.tools.shmring import ShmRings
+from apiary.tools.shmcounters import ShmCounters
+from apiary.tools.eventloop import EventLoop, run_sync, sleep_until
+from apiary.tools.timerwheel import Scheduler
+from apiary.tools.timemap import TimeMap, read_profile
+from apiary.tools.sampling import JobSampler, job_hash
+from apiary.tools.rewrite import build_rewriter
+from apiary.tools.concurrency import job_times, concurrency, plan_pool
+from apiary.tools.stats import Tally, Level, Series, Histogram, Breakdown, PERCENTILES
 from apiary.tools.table import format_table, ALIGN_LEFT, ALIGN_CENTER, ALIGN_RIGHT
 
 verbose = False
 
+# How often a QueenBee checks whether the job queues have room, while it holds
+# back jobs because of --max-queued.
+QUEUE_POLL_INTERVAL = 0.005
+
+# With --max-threads, a job that starts this many seconds late while every
+# thread in its worker process is busy adds a thread to the process.
+LATE_START_THRESHOLD = 0.01
+
+# The number of different tallies each worker process can count in shared
+# memory.  Any more are sent in its stats snapshots instead.
+TALLY_SLOTS = 64
+
+# Keys longer than this are cut short in breakdown tables.
+BREAKDOWN_KEY_WIDTH = 100
+
 
 class BeeKeeper(object):
     """Manages the hive, including QueenBee, WorkerBees, and StatsGatherer."""
@@ -72,47 +98,328 @@ class BeeKeeper(object):
             sys.exit('invalid protocol: %s (valid protocols: %s)' %
                      (options.protocol, " ".join(options.protocols)))
 
+        if options.engine == 'async' and not hasattr(self.protocol, 'AsyncWorkerBee'):
+            sys.exit('protocol %s does not support --engine async' % options.protocol)
+
+        if options.max_threads:
+            if options.engine == 'async':
+                sys.exit('--max-threads requires --engine thread')
+
+            if options.max_threads < options.threads:
+                sys.exit('--max-threads must be at least --threads')
+
+        if not 0 < options.histogram_error < 1:
+            sys.exit('--histogram-error must be between 0 and 1')
+
+        if options.stats_flush_interval <= 0:
+            sys.exit('--stats-flush-interval must be positive')
+
+        if options.stop_at is not None and options.stop_at <= options.start_at:
+            sys.exit('--stop-at must be later than --start-at')
+
+        if options.warmup < 0 or options.cooldown < 0:
+            sys.exit('--warmup and --cooldown must not be negative')
+
+        if options.warmup_speedup is not None:
+            if options.warmup_speedup <= 0:
+                sys.exit('--warmup-speedup must be positive')
+
+            if not options.warmup:
+                sys.exit('--warmup-speedup requires --warmup')
+
+        # Jobs run as if the capture began at --start-at.  A warmup at its own
+        # speedup comes before the load profile, if any.
+        if options.load_profile:
+            if options.concurrency:
+                sys.exit('--load-profile and --concurrency cannot be used together')
+
+            try:
+                segments = read_profile(options.load_profile)
+            except (IOError, ValueError), e:
+                sys.exit('invalid load profile: %s' % e)
+
+            speedup = None
+        else:
+            segments = []
+            speedup = options.speedup
+
+        if options.warmup_speedup is not None:
+            segments.insert(0, (options.warmup / options.warmup_speedup,
+                                options.warmup_speedup, options.warmup_speedup))
+
+        options.time_map = TimeMap(segments, speedup, origin=options.start_at)
+
+        try:
+            slice_num, num_slices = [int(n) for n in options.slice.split('/')]
+        except ValueError:
+            sys.exit('invalid --slice: %s (expected I/N)' % options.slice)
+
+        if not 0 <= slice_num < num_slices:
+            sys.exit('--slice I/N requires 0 <= I < N')
+
+        if not 0 < options.sample_rate <= 1:
+            sys.exit('--sample-rate must be greater than 0 and at most 1')
+
+        # With --loop or --duration, the capture (or the part of it between
+        # --start-at and --stop-at) repeats every loop_period seconds.
+        if options.loop is None:
+            options.loop = 0 if options.duration else 1
+
+        if options.loop < 0:
+            sys.exit('--loop must not be negative')
+
+        if options.loop == 0 and not options.duration:
+            sys.exit('--loop 0 requires --duration')
+
+        if options.loop != 1 or options.duration:
+            if options.stop_at is not None:
+                end = options.stop_at
+            else:
+                end = capture_end(arguments[0])
+
+            options.loop_period = end - options.start_at
+
+            if options.loop_period <= 0:
+                sys.exit('no jobs to loop after --start-at')
+        else:
+            options.loop_period = 0
+
+        options.phases = self.plan_phases()
+
+        # Shared memory slots have room for 16-bit copy numbers.
+        if not 1 <= options.amplify <= 65535:
+            sys.exit('--amplify must be between 1 and 65535')
+
+        try:
+            options.rewrite_request = build_rewriter(options.rewrite, options.rewrite_hook,
+                                                     options.amplify)
+        except (ImportError, AttributeError, ValueError, re.error), e:
+            sys.exit('invalid request rewrite: %s' % e)
+
+        options.job_sampler = JobSampler(options.sample_rate, options.sample_seed,
+                                         slice_num, num_slices,
+                                         options.skip, options.offset,
+                                         options.min_skip, options.ramp_time, options.start_at)
+
+        if options.auto_size:
+            self.auto_size()
+
+    def auto_size(self):
+        """Choose --workers and --threads to fit the most jobs that run at once."""
+
+        options = self.options
+
+        if options.concurrency:
+            peak = options.concurrency
+        else:
+            start_times, end_times = job_times(self.arguments[0], options.start_at, options.stop_at,
+                                               options.job_sampler)
+            times, counts = concurrency(start_times, end_times)
+
+            if not len(counts):
+                sys.exit('no jobs to run')
+
+            peak_num = counts.argmax()
+            peak = int(counts[peak_num]) * options.amplify
+
+            print "Peak concurrency: %d jobs, %0.1f seconds into the run." % (
+                peak, options.time_map.run_time(times[peak_num]))
+
+        options.workers, options.threads = plan_pool(peak, cpu_count(), options.auto_size_headroom / 100.0,
+                                                     options.engine)
+
+        if options.max_threads:
+            options.max_threads = max(options.max_threads, options.threads)
+
+        print "Running %d workers with %d threads each (%d%% headroom over %d jobs)." % (
+            options.workers, options.threads, options.auto_size_headroom, peak)
+
+    def plan_phases(self):
+        """Return [(name, capture start time)] for the run's phases.
+
+        Returns an empty list unless there's a warmup or a cooldown.  Capture
+        times count up across loops, as in the QueenBee's schedule.
+        """
+
+        options = self.options
+
+        if not options.warmup and not options.cooldown:
+            return []
+
+        if options.cooldown and options.concurrency and options.duration:
+            sys.exit('--cooldown cannot be used with --concurrency and --duration, '
+                     'since the run then ends by the clock rather than by capture time')
+
+        start = options.start_at
+        time_map = options.time_map
+
+        if options.loop_period:
+            end = start + options.loop * options.loop_period if options.loop else None
+
+            if options.duration:
+                duration_end = time_map.capture_time(options.duration)
+                end = duration_end if end is None else min(end, duration_end)
+        elif options.stop_at is not None:
+            end = options.stop_at
+        else:
+            end = capture_end(self.arguments[0])
+
+        if start + options.warmup + options.cooldown >= end:
+            sys.exit('--warmup and --cooldown leave nothing to measure')
+
+        phases = []
+
+        if options.warmup:
+            phases.append(('warmup', start))
+
+        phases.append(('measure', start + options.warmup))
+
+        if options.cooldown:
+            phases.append(('cooldown', end - options.cooldown))
+
+        return phases
+
+    def wait_for_workers(self, workers, ready_queue, start_time):
+        """Wait until every worker process is ready to run jobs.
+
+        Each worker process reports once all of its WorkerBees exist (and,
+        with --warm-connections, have warmed up), along with how long each
+        step of its startup took.
+        """
+
+        timings = defaultdict(list)
+        steps = []
+
+        for i in xrange(len(workers)):
+            while True:
+                try:
+                    report = ready_queue.get(timeout=1)
+                    break
+                except Empty:
+                    if not all(worker.is_alive() for worker in workers):
+                        sys.exit('a worker process exited during startup')
+
+            for step, seconds in report:
+                if step not in timings:
+                    steps.append(step)
+
+                timings[step].append(seconds)
+
+        print "Workers ready after %0.2f seconds." % (time.time() - start_time)
+
+        table = []
+
+        for step in steps:
+            seconds = timings[step]
+            table.append([(ALIGN_RIGHT, "%s (s): " % step),
+                          (ALIGN_RIGHT, "min:"), (ALIGN_LEFT, "%0.3f" % min(seconds)),
+                          (ALIGN_RIGHT, "mean:"), (ALIGN_LEFT, "%0.3f" % numpy.mean(seconds)),
+                          (ALIGN_RIGHT, "max:"), (ALIGN_LEFT, "%0.3f" % max(seconds))])
+
+        print format_table(table) or "",
+
     def start(self):
         """Run the load test."""
 
         start_time = time.time()
 
-        job_queue = Queue()
+        num_queens = self.options.queens
+
+        if not 1 <= num_queens <= self.options.workers:
+            sys.exit('--queens must be between 1 and --workers')
+
+        if self.options.concurrency > self.options.workers * self.options.threads:
+            sys.exit('--concurrency may be at most --workers times --threads')
+
+        if self.options.max_queued < 0:
+            sys.exit('--max-queued must not be negative')
+
+        # The number of jobs the QueenBees have sent that no worker process
+        # has taken off its job queue yet.
+        queued_jobs = Value('l', 0)
+
+        # With --concurrency, QueenBees take a slot for each job they send,
+        # and workers give it back once the job is finished.
+        if self.options.concurrency:
+            job_slots = Semaphore(self.options.concurrency)
+        else:
+            job_slots = None
+
+        # Each QueenBee feeds its own job queue, which is read by its own
+        # subset of the workers.
+        if self.options.transport == 'shm':
+            rings = ShmRings(self.options.workers, self.options.shm_slots)
+            job_queues = [ShmJobQueue(rings, range(i, self.options.workers, num_queens))
+                          for i in xrange(num_queens)]
+            worker_queues = [ShmJobReader(rings, i, self.arguments[0])
+                             for i in xrange(self.options.workers)]
+        else:
+            job_queues = [Queue() for i in xrange(num_queens)]
+            worker_queues = [job_queues[i % num_queens] for i in xrange(self.options.workers)]
+
         stats_queue = Queue()
+        ready_queue = Queue()
+
+        # Each WorkerBee thread, or each worker process's event loop, counts
+        # tallies in a row of shared memory of its own.
+        if self.options.engine == 'async':
+            writers = 1
+        else:
+            writers = max(self.options.threads, self.options.max_threads)
+
+        counters = ShmCounters(self.options.workers, writers, TALLY_SLOTS)
 
         workers = []
 
         delay = self.options.stagger_workers / 1000.0
         for i in xrange(self.options.workers):
-            worker = WorkerBeeProcess(self.options, self.protocol, job_queue, stats_queue)
+            worker = WorkerBeeProcess(self.options, self.protocol, worker_queues[i], stats_queue, job_slots,
+                                      ready_queue, queued_jobs, counters, i)
             worker.start()
             workers.append(worker)
             time.sleep(delay)
 
-        # TODO: consider waiting until workers are ready
-        #if self.options.startup_wait:
-        #    print "workers started; waiting %d seconds..." % self.options.startup_wait
-        #    time.sleep(self.options.startup_wait)
+        self.wait_for_workers(workers, ready_queue, start_time)
+
+        # All queens share one start time so that their jobs run on the same
+        # schedule.
+        queen_start_time = time.time() + self.options.startup_wait
 
-        stats_gatherer = StatsGatherer(self.options, stats_queue)
+        # The StatsGatherer handles SIGUSR1 itself, once it's running.  The
+        # BeeKeeper passes on any that it receives.
+        signal.signal(signal.SIGUSR1, signal.SIG_IGN)
+
+        stats_gatherer = StatsGatherer(self.options, stats_queue, queen_start_time, counters)
         stats_gatherer.start()
 
-        queen = QueenBee(self.options, self.arguments, job_queue, stats_queue)
-        queen.start()
+        signal.signal(signal.SIGUSR1, lambda signum, frame: os.kill(stats_gatherer.pid, signal.SIGUSR1))
+
+        queens = []
+
+        for i in xrange(num_queens):
+            queen = QueenBee(self.options, self.arguments, job_queues[i], stats_queue, queen_start_time, i,
+                             job_slots, queued_jobs)
+            queen.start()
+            queens.append(queen)
 
-        # Now wait while the queen does its thing.
+        # Now wait while the queens do their thing.
         try:
-            queen.join()
+            for queen in queens:
+                queen.join()
         except KeyboardInterrupt:
             print "Interrupted, shutting down..."
-            queen.terminate()
+            for queen in queens:
+                queen.terminate()
 
         print "Waiting for workers to complete jobs and terminate (may take up to %d seconds)..." % self.options.max_ahead
 
         try:
+            # Each worker process reads its job queue from a single feeder
+            # thread, which passes the STOP on to all of its WorkerBees.
             stop = Message(Message.STOP)
-            for worker in xrange(self.options.workers * self.options.threads):
-                job_queue.put(stop)
+            for i, job_queue in enumerate(job_queues):
+                for worker in xrange(i, self.options.workers, num_queens):
+                    job_queue.put(stop)
 
             # Now wait for the workers to get the message.  This may take a few
             # minutes as the QueenBee likes to stay ahead by a bit.
@@ -125,12 +432,15 @@ class BeeKeeper(object):
 
             # Wait for it to finish.
             stats_gatherer.join()
+            signal.signal(signal.SIGUSR1, signal.SIG_IGN)
 
-            print "Completed %d jobs in %0.2f seconds." % (queen.jobs_sent.value, time.time() - start_time)
+            jobs_sent = sum(queen.jobs_sent.value for queen in queens)
+            print "Completed %d jobs in %0.2f seconds." % (jobs_sent, time.time() - start_time)
         except KeyboardInterrupt:
             print "Interrupted before shutdown process completed."
 
-            job_queue.cancel_join_thread()
+            for job_queue in job_queues:
+                job_queue.cancel_join_thread()
             stats_queue.cancel_join_thread()
 
 
@@ -138,24 +448,76 @@ class StatsGatherer(ChildProcess):
     """Gather and present stats.
 
     The StatsGatherer process reads messages off of the stats queue sent by the
-    workers and aggregates them.  It prints a report periodically.
+    workers and aggregates them.  It prints a report periodically.  Worker
+    processes send their stats as snapshots (see StatsBuffer), which are merged
+    in as they arrive.  Most tallies are instead counted in shared memory (see
+    tools.shmcounters), and read each time the StatsGatherer reports.
+
+    Breakdowns cover the whole run.  The StatsGatherer prints the busiest
+    --breakdown-size keys of each at the end, or on SIGUSR1.
 
     See tools.stats for a description of the kinds of statistics that are
     available.
+
+    With --warmup or --cooldown, the run is split into phases.  At the start of
+    each phase, the StatsGatherer reports and starts its tallies and series
+    afresh, and at the end it prints a summary of each phase.  Levels start
+    the new phase at their current value, since they track how much is going
+    on right now.
+
+    Phases begin when the schedule says their first jobs are due.  With
+    --concurrency or --asap, there's no schedule to go by, so the first
+    QueenBee sends a PHASE message as it reaches each phase's jobs instead.
     """
 
-    def __init__(self, options, stats_queue):
+    def __init__(self, options, stats_queue, start_time, counters=None):
         super(StatsGatherer, self).__init__()
 
         self._options = options
         self._verbose = options.verbose
+        self._new_series = partial(Series, options.histogram_error)
         self._tallies = defaultdict(Tally)
         self._levels = defaultdict(Level)
-        self._series = defaultdict(Series)
+        self._series = defaultdict(self._new_series)
+        self._breakdowns = defaultdict(partial(Breakdown, options.histogram_error))
+        self._breakdowns_requested = False
         self._last_report = time.time()
         self._worker_count = 0
         self._queue = stats_queue
 
+        # The name of each worker process's shared-memory counters, and how
+        # much of each has been added to the tallies so far.
+        self._counters = counters
+        self._slot_names = defaultdict(dict)
+
+        if counters:
+            self._counted = numpy.zeros((counters.num_processes, counters.num_slots), dtype=numpy.uint64)
+
+        # Phases as (name, wall clock start time).  The first begins now, even
+        # if the QueenBees haven't started yet.
+        self._phases = deque((name, start_time + options.time_map.run_time(capture_start))
+                             for name, capture_start in options.phases)
+        self._phase = None
+        self._phase_start = None
+        self._phase_summaries = []
+
+        if self._phases:
+            self.start_phase(self._phases.popleft()[0])
+
+        # Without a schedule, the rest wait for PHASE messages.
+        if options.concurrency or options.asap:
+            self._phases.clear()
+
+        # With --concurrency, keep a histogram of request durations for the
+        # summary.
+        if options.concurrency:
+            self._durations = Histogram(options.histogram_error)
+        else:
+            self._durations = None
+
+        self._first_request = None
+        self._last_request = None
+
     @traced_method
     def worker_status(self, message):
         if message.type == Message.STOP:
@@ -170,14 +532,80 @@ class StatsGatherer(ChildProcess):
         elif message.type == Message.STAT_SERIES:
             #print "series", message.body[0], message.body[1]
             self._series[message.body[0]].add(message.body[1])
+
+            if message.body[0] == "Request Duration (ms)":
+                self.count_durations(message.body[1])
+        elif message.type == Message.STAT_SNAPSHOT:
+            source, tallies, levels, series, breakdowns, slot_names = message.body
+
+            self._slot_names[source].update(slot_names)
+
+            for name, count in tallies.iteritems():
+                self._tallies[name].add(count)
+
+            for name, (level, seconds) in levels.iteritems():
+                self._levels[name].merge(source, level, seconds)
+
+            for name, histogram in series.iteritems():
+                self._series[name].merge(histogram)
+
+            if "Request Duration (ms)" in series:
+                self.count_durations(series["Request Duration (ms)"])
+
+            for name, histograms in breakdowns.iteritems():
+                self._breakdowns[name].merge(histograms)
+        elif message.type == Message.PHASE:
+            self.start_phase(message.body)
         else:
             print >> sys.stderr, "Received unknown worker status: %s" % message
 
+    def count_durations(self, durations):
+        """Add a request duration, or a Histogram of them, for --concurrency."""
+
+        if self._durations is None or self._phase not in (None, 'measure'):
+            return
+
+        if isinstance(durations, Histogram):
+            self._durations.merge(durations)
+        else:
+            self._durations.add(durations)
+
+        self._last_request = time.time()
+
+        if self._first_request is None:
+            self._first_request = self._last_request
+
+    def read_counters(self):
+        """Add the counts in shared memory since the last call to the tallies."""
+
+        if not self._counters:
+            return
+
+        totals = self._counters.totals()
+
+        for worker, slot in zip(*numpy.nonzero(totals != self._counted)):
+            # Leave counts for slots whose names haven't arrived yet for next
+            # time.
+            name = self._slot_names[worker].get(slot)
+
+            if name is not None:
+                tally = self._tallies.get(name)
+
+                if tally is None:
+                    tally = self._tallies[name] = Tally(self._last_report)
+
+                tally.add(int(totals[worker, slot] - self._counted[worker, slot]))
+                self._counted[worker, slot] = totals[worker, slot]
+
     def report(self):
+        self.read_counters()
         self._last_report = time.time()
 
         timestamp = datetime.now().strftime('%F %T')
 
+        if self._phase:
+            timestamp += " (%s)" % self._phase
+
         print
         print timestamp
         print "=" * len(timestamp)
@@ -196,168 +624,551 @@ class StatsGatherer(ChildProcess):
 
         print format_table(table) or "",
 
+    def start_phase(self, name):
+        """Finish the current phase, if any, and begin a new one."""
+
+        if self._phase:
+            self.end_phase()
+
+        self._phase = name
+        self._phase_start = time.time()
+        self._tallies = defaultdict(Tally)
+        self._series = defaultdict(self._new_series)
+        self._levels = defaultdict(Level, ((level_name, level.carry_over())
+                                           for level_name, level in self._levels.iteritems()))
+
+    def end_phase(self):
+        self.report()
+
+        table = []
+
+        for name, stat in (sorted(self._tallies.items()) +
+                           sorted(self._levels.items()) +
+                           sorted(self._series.items())):
+            summary = stat.summarize()
+
+            if summary:
+                row = [(ALIGN_RIGHT, "%s: " % name)]
+
+                for field, value in summary.iteritems():
+                    row.append((ALIGN_RIGHT, field.lower() + ":"))
+
+                    if isinstance(value, (int, long)):
+                        row.append((ALIGN_LEFT, "%d" % value))
+                    else:
+                        row.append((ALIGN_LEFT, stat.format_number(value)))
+
+                table.append(row)
+
+        self._phase_summaries.append((self._phase, time.time() - self._phase_start, table))
+
+    def summarize_phases(self):
+        """Print the tallies, levels and series of each phase."""
+
+        if not self._phase_summaries:
+            return
+
+        print
+        print "Phases"
+        print "======"
+
+        for name, elapsed, table in self._phase_summaries:
+            print
+            print "%s (%0.1f seconds):" % (name, elapsed)
+            print format_table(table) or "",
+
+    def print_breakdowns(self):
+        """Print the keys with the largest totals in each breakdown."""
+
+        for name, breakdown in sorted(self._breakdowns.iteritems()):
+            top = breakdown.top(self._options.breakdown_size)
+            title = "%s: top %d of %d by total" % (name, len(top), len(breakdown))
+
+            print
+            print title
+            print "=" * len(title)
+
+            table = [[(ALIGN_RIGHT, "count"), (ALIGN_RIGHT, "total"), (ALIGN_RIGHT, "mean"),
+                      (ALIGN_RIGHT, "p99"), (ALIGN_LEFT, "")]]
+
+            for key, histogram in top:
+                key = str(key)
+
+                if len(key) > BREAKDOWN_KEY_WIDTH:
+                    key = key[:BREAKDOWN_KEY_WIDTH - 3] + "..."
+
+                p99 = histogram.percentiles([99])[0]
+                table.append([(ALIGN_RIGHT, "%d" % histogram.count),
+                              (ALIGN_RIGHT, "%0.1f" % histogram.total),
+                              (ALIGN_RIGHT, "%0.3f" % histogram.mean),
+                              (ALIGN_RIGHT, "%0.3f" % p99),
+                              (ALIGN_LEFT, key)])
+
+            print format_table(table) or "",
+
+    def request_breakdowns(self, signum, frame):
+        self._breakdowns_requested = True
+
+    def summarize(self):
+        """Print the throughput and latency of the whole run."""
+
+        if not self._durations or not self._durations.count:
+            return
+
+        durations = self._durations
+        elapsed = self._last_request - self._first_request
+
+        print
+        print "Concurrency %d:" % self._options.concurrency
+
+        table = [[(ALIGN_RIGHT, "Requests: "), (ALIGN_LEFT, "%d" % durations.count)]]
+
+        if elapsed > 0:
+            table.append([(ALIGN_RIGHT, "Requests/s: "), (ALIGN_LEFT, "%0.1f" % (durations.count / elapsed))])
+
+        for percentile, value in zip(PERCENTILES, durations.percentiles()):
+            table.append([(ALIGN_RIGHT, "p%s (ms): " % percentile),
+                          (ALIGN_LEFT, "%0.3f" % value)])
+
+        print format_table(table) or "",
+
     def run_child_process(self):
+        signal.signal(signal.SIGUSR1, self.request_breakdowns)
+
         while True:
+            timeout = 1
+
+            if self._phases:
+                timeout = min(timeout, max(0, self._phases[0][1] - time.time()))
+
             try:
-                done = self.worker_status(self._queue.get(timeout=1))
+                done = self.worker_status(self._queue.get(timeout=timeout))
             except Empty:
                 done = False
 
-            if done or time.time() - self._last_report > self._options.stats_interval:
-                self.report()
-
             if done:
+                if self._phase:
+                    self.end_phase()
+                    self.summarize_phases()
+                else:
+                    self.report()
+
+                self.print_breakdowns()
+                self.summarize()
                 break
 
+            if self._breakdowns_requested:
+                self._breakdowns_requested = False
+                self.print_breakdowns()
+
+            if self._phases and time.time() >= self._phases[0][1]:
+                self.start_phase(self._phases.popleft()[0])
+            elif time.time() - self._last_report > self._options.stats_interval:
+                self.report()
+
 
 class QueenBee(ChildProcess):
-    """A QueenBee process that distributes sequences of events"""
+    """A QueenBee process that distributes sequences of events
 
-    def __init__(self, options, arguments, job_queue, stats_queue):
+    With --queens, several QueenBees run at once.  Each one sends every Nth job
+    in the jobs file, starting with job number queen_num.
+
+    With --concurrency, a QueenBee ignores when jobs are meant to start and
+    instead sends each job as soon as it can take one of job_slots.
+
+    Otherwise, a QueenBee sends jobs ahead of time, but no more than
+    --max-ahead seconds ahead, and only while fewer than --max-queued jobs
+    are waiting in the job queues (as counted by queued_jobs).  How far ahead
+    that is depends on how many jobs start close together.  A job held back
+    by --max-queued is still sent by the time it's meant to start.  With
+    --asap, jobs aren't due at any particular time, so --max-queued alone
+    holds them back.
+
+    With --concurrency or --asap, QueenBee 0 also tells the StatsGatherer
+    when it reaches the first job of each phase after the first (see
+    StatsGatherer).
+    """
+
+    def __init__(self, options, arguments, job_queue, stats_queue, start_time, queen_num=0,
+                 job_slots=None, queued_jobs=None):
         super(QueenBee, self).__init__()
 
         self._options = options
         self._verbose = options.verbose
         self._jobs_file = arguments[0]
         self._index_file = arguments[0] + ".index"
-        self._time_scale = 1.0 / options.speedup
+        self._time_map = options.time_map
         self._last_warning = 0
-        self._skip_counter = options.skip
-        self._last_job_start_time = 0
-        self._skip = options.skip
+        self._last_lag_report = 0
+        self._last_queue_report = 0
+        self._job_sampler = options.job_sampler
+        self._amplify = options.amplify
+        self._loops = options.loop
+        self._loop_period = options.loop_period
+        self._duration = options.duration
+        self._start_at = options.start_at
+        self._stop_at = options.stop_at
+        self._batch_window = options.batch_window / 1000.0
+        self._batch_size = options.batch_size or options.threads
+        self._start_time = start_time
+        self._queen_num = queen_num
+        self._num_queens = options.queens
         self.jobs_sent = Value('L', 0)
         self.job_queue = job_queue
         self.stats_queue = stats_queue
+        self._job_slots = job_slots
+        self._queued_jobs = queued_jobs
+        self._max_queued = options.max_queued if queued_jobs else 0
+
+        # Phases as (name, capture start time), for QueenBee 0 to announce.
+        if queen_num == 0 and (options.concurrency or options.asap):
+            self._phases = deque(options.phases[1:])
+        else:
+            self._phases = deque()
 
         if os.path.exists(self._index_file):
-            self.use_index = True
+            self._index_format = index_format(self._index_file)
         else:
-            self.use_index = False
+            self._index_format = None
 
-    def run_child_process(self):
-        start_time = time.time() + self._options.startup_wait
+    def read_jobs(self):
+        """Yield (job_id, start_time, offset, length, loop) for each job to be run.
 
-        if self.use_index:
-            jobs_file = open(self._index_file, 'rb')
+        The length of a job is 0 if it isn't known.  With --loop or --duration,
+        the jobs repeat, with start times shifted by loop_period on each loop.
+        The jobs chosen on the first loop are kept in memory (as index records,
+        with a binary index) so that later loops don't read from disk.
+        """
+
+        if self._index_format == 'binary':
+            records = iter_index
         else:
-            jobs_file = open(self._jobs_file, 'rb')
+            records = iter
 
-        job_num = 0
+        looping = self._loops != 1 or self._duration
+        cache = []
 
-        while True:
-            try:
-                if self.use_index:
-                    job_id, job_start_time, job_offset = cPickle.load(jobs_file)
-                else:
-                    job_offset = jobs_file.tell()
-                    job_id, tasks = cPickle.load(jobs_file)
+        for block in self.read_job_blocks():
+            if looping:
+                cache.append(block)
 
-                    if not tasks:
-                        continue
+            for job in records(block):
+                yield job + (0,)
 
-                    job_start_time = tasks[0][0]
+        if not looping or not cache:
+            return
 
-                job_num += 1
+        if self._loops:
+            loops = xrange(1, self._loops)
+        else:
+            loops = count(1)
 
-                if self._options.ramp_time:
-                    # Adjust skip counter once per second since ramp_time has
-                    # one-second resolution anyway.
+        for loop in loops:
+            shift = loop * self._loop_period
 
-                    job_start_second = int(job_start_time)
-                    if job_start_second > self._last_job_start_time:
-                        self._skip = max(self._options.min_skip,
-                                         self._options.skip - (job_start_second / self._options.ramp_time))
+            for block in cache:
+                for job_id, start_time, offset, length in records(block):
+                    yield job_id, start_time + shift, offset, length, loop
 
-                    self._last_job_start_time = job_start_second
+    def read_job_blocks(self):
+        """Yield the jobs in the capture that are to be run, in blocks.
 
-                if self._skip:
-                    if self._skip_counter == 0:
-                        self._skip_counter = self._skip
-                    else:
-                        self._skip_counter -= 1
+        With a binary index, blocks are arrays of index records.  Otherwise,
+        they're lists of (job_id, start_time, offset, length).  Blocks are
+        never empty.
 
-                    if self._skip_counter != self._options.offset:
-                        continue
+        Only jobs starting between --start-at and --stop-at are included.  Jobs
+        files are in order of start time, so with a binary index, the QueenBee
+        can find them with a binary search.
+        """
 
-                # Check whether we're falling behind, and throttle sending so as
-                # not to overfill the queue.
+        if self._index_format == 'binary':
+            index = open_index(self._index_file)
 
-                if not self._options.asap:
-                    offset = job_start_time * self._time_scale - (time.time() - start_time)
+            if self._start_at or self._stop_at is not None:
+                start_times = index['start_time']
+                begin = numpy.searchsorted(start_times, self._start_at, 'left')
 
-                    if offset > self._options.max_ahead:
-                        time.sleep(offset - self._options.max_ahead)
-                    elif offset < -10.0:
-                        if time.time() - self._last_warning > 60:
-                            print "WARNING: Queenbee is %0.2f seconds behind." % (-offset)
-                            self._last_warning = time.time()
+                if self._stop_at is None:
+                    end = len(index)
+                else:
+                    end = numpy.searchsorted(start_times, self._stop_at, 'left')
+
+                index = index[begin:end]
 
-                message = Message(Message.JOB, (start_time, job_id, self._jobs_file, job_offset))
-                self.job_queue.put(message)
-            except EOFError:
+            index = index[self._queen_num::self._num_queens]
+
+            for chunk in iter_index_chunks(index, self._job_sampler.filter_index):
+                # Sampling may leave nothing in a chunk.  Looping over cached
+                # empty blocks would never yield a job.
+                if len(chunk):
+                    yield chunk
+        else:
+            jobs = (job for job_num, job in enumerate(self.read_unindexed_jobs())
+                    if job_num % self._num_queens == self._queen_num)
+            jobs = self._job_sampler.filter_jobs(jobs)
+
+            while True:
+                block = list(islice(jobs, CHUNK_SIZE))
+
+                if not block:
+                    break
+
+                yield block
+
+    def read_unindexed_jobs(self):
+        for job in self.read_all_unindexed_jobs():
+            if self._stop_at is not None and job[1] >= self._stop_at:
                 break
 
+            if job[1] >= self._start_at:
+                yield job
+
+    def read_all_unindexed_jobs(self):
+        if self._index_format == 'pickle':
+            with open(self._index_file, 'rb') as index_file:
+                for job_id, job_start_time, job_offset in iter_pickle_index(index_file):
+                    yield job_id, job_start_time, job_offset, 0
+        else:
+            with open(self._jobs_file, 'rb') as jobs_file:
+                for job_offset, job_length, (job_id, tasks) in iter_jobs(jobs_file):
+                    if tasks:
+                        yield job_id, tasks[0][0], job_offset, job_length
+
+    def run_child_process(self):
+        start_time = self._start_time
+
+        job_num = 0
+        batch = []
+        batch_start_time = 0
+
+        # With --amplify, each job is sent several times.  Workers tell the
+        # copies apart by their copy numbers.
+        copies = range(self._amplify)
+
+        for job_id, job_start_time, job_offset, job_length, loop in self.read_jobs():
+            if self._duration:
+                # In closed-loop mode, jobs run whenever they can, so only the
+                # clock says how far into the run we are.
+                if self._job_slots:
+                    elapsed = time.time() - start_time
+                else:
+                    elapsed = self._time_map.run_time(job_start_time)
+
+                if elapsed >= self._duration:
+                    break
+
+            while self._phases and job_start_time >= self._phases[0][1]:
+                self.stats_queue.put(Message(Message.PHASE, self._phases.popleft()[0]))
+
+            job_num += len(copies)
+
+            now = time.time()
+
+            if self._queued_jobs and self._queen_num == 0 and now - self._last_queue_report >= 1:
+                self.stats_queue.put(Message(Message.STAT_SERIES, ("Queued Jobs", self._queued_jobs.value)))
+                self._last_queue_report = now
+
+            if self._job_slots:
+                for copy in copies:
+                    self._job_slots.acquire()
+                    message = Message(Message.JOB, (start_time, job_id, self._jobs_file, job_offset, job_length, copy, loop))
+                    self.put_jobs(message, 1)
+                continue
+
+            # Check whether we're falling behind, and throttle sending so as
+            # not to overfill the queue.
+
+            if not self._options.asap:
+                offset = self._time_map.run_time(job_start_time) - (now - start_time)
+
+                if now - self._last_lag_report >= 1:
+                    self.stats_queue.put(Message(Message.STAT_SERIES, ("QueenBee Lag (s)", max(0, -offset))))
+                    self._last_lag_report = now
+
+                if offset > self._options.max_ahead:
+                    # Don't hold back jobs we've already read while we wait.
+                    self.send_batch(start_time, batch)
+                    batch = []
+
+                    time.sleep(offset - self._options.max_ahead)
+                elif offset > 0 and self._max_queued and self._queued_jobs.value >= self._max_queued:
+                    self.send_batch(start_time, batch)
+                    batch = []
+
+                    self.wait_for_room(now + offset)
+                elif offset < -10.0:
+                    if time.time() - self._last_warning > 60:
+                        print "WARNING: Queenbee is %0.2f seconds behind." % (-offset)
+                        self._last_warning = time.time()
+            elif self._max_queued and self._queued_jobs.value >= self._max_queued:
+                self.send_batch(start_time, batch)
+                batch = []
+
+                self.wait_for_room()
+
+            if not self._batch_window:
+                for copy in copies:
+                    message = Message(Message.JOB, (start_time, job_id, self._jobs_file, job_offset, job_length, copy, loop))
+                    self.put_jobs(message, 1)
+                continue
+
+            # Group jobs that start within the batch window of each other into
+            # a single message.  The window is measured in run time.
+
+            scaled_start_time = self._time_map.run_time(job_start_time)
+
+            for copy in copies:
+                if batch and (len(batch) >= self._batch_size or
+                              scaled_start_time - batch_start_time > self._batch_window):
+                    self.send_batch(start_time, batch)
+                    batch = []
+
+                if not batch:
+                    batch_start_time = scaled_start_time
+
+                batch.append((job_id, job_offset, job_length, copy, loop))
+
+        self.send_batch(start_time, batch)
+
         self.jobs_sent.value = job_num
 
-class WorkerBee(Thread):
-    """The thread that does the actual job processing"""
+    def send_batch(self, start_time, batch):
+        if batch:
+            message = Message(Message.JOB_BATCH, (start_time, self._jobs_file, tuple(batch)))
+            self.put_jobs(message, len(batch))
 
-    EXCHANGE = 'b.direct'
+    def put_jobs(self, message, num_jobs):
+        """Send a message holding num_jobs jobs to the job queue."""
+
+        if self._queued_jobs:
+            with self._queued_jobs.get_lock():
+                self._queued_jobs.value += num_jobs
 
-    def __init__(self, options, job_queue, stats_queue):
-        super(WorkerBee, self).__init__()
+        self.job_queue.put(message)
 
+    def wait_for_room(self, deadline=None):
+        """Wait until fewer than --max-queued jobs are queued, or until deadline, if given."""
+
+        while self._queued_jobs.value >= self._max_queued:
+            if deadline is None:
+                time.sleep(QUEUE_POLL_INTERVAL)
+                continue
+
+            remaining = deadline - time.time()
+
+            if remaining <= 0:
+                break
+
+            time.sleep(min(remaining, QUEUE_POLL_INTERVAL))
+
+class Bee(object):
+    """The part of a worker that runs jobs.
+
+    A WorkerBee runs jobs one at a time in a thread of its own.  With
+    --engine async, each AsyncWorkerBee instead runs its jobs as coroutines on
+    its worker process's EventLoop.
+
+    run_job() is a coroutine (see tools.eventloop).  Protocol plugins implement
+    start_job(), send_request() and finish_job(), either as plain methods (for
+    a WorkerBee) or as coroutines (for an AsyncWorkerBee).
+
+    Stats go to the worker process's StatsBuffer.
+    """
+
+    def __init__(self, options, stats, job_slots=None):
         self.options = options
-        self.job_queue = job_queue
-        self.stats_queue = stats_queue
+        self.stats = stats
+        self.job_slots = job_slots
         self.dry_run = options.dry_run
         self.asap = options.asap
         self.verbose = options.verbose >= 1
         self.debug = options.debug
         self.time_scale = 1.0 / options.speedup
+        self.time_map = options.time_map
+        self.closed_loop = bool(options.concurrency)
+        self.think_time = options.think_time
+        self.amplify_jitter = options.amplify_jitter / 1000.0
+        self.rewrite_request = options.rewrite_request
+        self.loop_period = options.loop_period
+
+        # Called when a job starts late, if set.
+        self.late_start_hook = None
+
+        # Where to count tallies in shared memory (a CounterRow), if set.
+        self.counters = None
 
     def status(self, status, body=None):
-        self.stats_queue.put(Message(status, body))
+        self.stats.put(Message(status, body))
 
     def error(self, message):
-        self.status(Message.STAT_TALLY, "ERR: <%s>" % message)
+        self.tally("ERR: <%s>" % message)
 
     def tally(self, name):
-        self.status(Message.STAT_TALLY, name)
+        if not (self.counters and self.counters.add(name)):
+            self.stats.tally(name)
 
     def level(self, name, increment):
-        self.status(Message.STAT_LEVEL, (name, increment))
+        self.stats.level(name, increment)
 
     def series(self, name, value):
-        self.status(Message.STAT_SERIES, (name, value))
+        self.stats.series(name, value)
 
-    def process_message(self, message):
-        if message.type == Message.STOP:
-            return True
-        elif message.type == Message.JOB:
-            # Messages look like this:
-            # (start_time, job_id, job_file, offset)
-            start_time, job_id, job_file, offset = message.body
+    def breakdown(self, name, key, value):
+        self.stats.breakdown(name, key, value)
+
+    def run_job(self, message):
+        # Messages look like this:
+        # (start_time, job_id, job_file, offset, length, copy, loop)
+        start_time, job_id, job_file, offset, length, copy, loop = message.body
+
+        # Jobs look like this:
+        # (job_id, ((time, request), (time, request), ...))
+        read_job_id, tasks = map_jobs_file(job_file).read_job(offset, length)
+
+        # A binary index stores a key derived from the job ID rather than
+        # the job ID itself.
+        if job_key(job_id) != job_key(read_job_id):
+            print "ERROR: worker read the wrong job: expected %s, read %s" % (job_id, read_job_id)
+            return
 
-            with open(job_file) as f:
-                f.seek(offset)
+        job_id = read_job_id
 
-                # Jobs look like this:
-                # (job_id, ((time, request), (time, request), ...))
-                read_job_id, tasks = cPickle.load(f)
+        if loop:
+            # Give each loop's run of a job an ID of its own.
+            job_id = "%s.%d" % (job_id, loop)
 
-            if job_id != read_job_id:
-                print "ERROR: worker read the wrong job: expected %s, read %s" % (job_id, read_job_id)
-                return
+        if self.dry_run or not tasks:
+            return
 
-            if self.dry_run or not tasks:
-                return
+        if copy:
+            # Spread out the copies of an amplified job, by the same amount
+            # on every run.
+            start_time += job_hash(job_key(job_id), copy) * self.amplify_jitter
 
-            started = False
-            error = False
+        run_time = self.time_map.run_time
 
+        if self.closed_loop:
+            # The job starts now, whenever it was originally meant to start.
+            if self.think_time == 'drop':
+                time_scale = 0
+            else:
+                time_scale = self.time_scale
+
+            run_time = lambda timestamp: timestamp * time_scale
+            start_time = time.time() - run_time(tasks[0][0] + loop * self.loop_period)
+
+        # On later loops, jobs run as though the capture were repeated.
+        shift = loop * self.loop_period
+
+        started = False
+        error = False
+
+        # If the protocol raises, the job is still finished and the levels put
+        # back before the exception goes on to whoever ran the job.
+        try:
             for timestamp, request in tasks:
-                target_time = timestamp * self.time_scale + start_time
+                target_time = run_time(timestamp + shift) + start_time
                 offset = target_time - time.time()
 
                 # TODO: warn if falling behind?
@@ -367,31 +1178,62 @@ class WorkerBee(Thread):
                     debug('sleeping %0.4f seconds' % offset)
                     if offset > 120 and self.verbose:
                         print "long wait of %ds for job %s" % (offset, job_id)
-                    time.sleep(offset)
+                    yield sleep_until(target_time)
+                    self.series("Firing Error (ms)", (time.time() - target_time) * 1000)
                 #elif offset < -1:
                 #    print "worker fell behind by %.5f seconds" % (-offset)
 
                 if not started:
+                    if offset < -LATE_START_THRESHOLD and self.late_start_hook:
+                        self.late_start_hook()
+
                     self.level("Jobs Running", "+")
-                    self.start_job(job_id)
                     started = True
+                    yield self.start_job(job_id)
+
+                if copy and self.rewrite_request:
+                    request = self.rewrite_request(request, copy)
 
                 #print "sending request", request
                 self.level("Requests Running", "+")
                 request_start_time = time.time()
-                error = not self.send_request(request)
+                try:
+                    error = not (yield self.send_request(request))
+                finally:
+                    self.level("Requests Running", "-")
                 request_end_time = time.time()
-                self.level("Requests Running", "-")
                 self.tally("Requests Completed")
                 self.series("Request Duration (ms)", (request_end_time - request_start_time) * 1000)
+
+                # Time spent waiting for a late job, a slow connection or a slow
+                # earlier request counts against the request that was held up.
+                if not self.asap:
+                    self.series("Schedule Lag (ms)", (request_start_time - target_time) * 1000)
+                    self.series("Corrected Request Duration (ms)", (request_end_time - target_time) * 1000)
                 if error:
                     break
+        finally:
+            try:
+                yield self.finish_job(job_id)
+            finally:
+                if started:
+                    self.level("Jobs Running", "-")
+
+        if not error:
+            self.tally("Jobs Completed")
+
+    def prepare(self):
+        """Coroutine run once before any jobs, while the hive starts up."""
 
-            self.finish_job(job_id)
-            self.level("Jobs Running", "-")
+        if self.options.warm_connections:
+            yield self.warmup()
 
-            if not error:
-                self.tally("Jobs Completed")
+    def warmup(self):
+        """Get ready to run jobs, with --warm-connections.
+
+        Protocol plugins may open a connection here for the first job to use.
+        """
+        pass
 
     def start_job(self, job_id):
         pass
@@ -405,17 +1247,476 @@ class WorkerBee(Thread):
     def finish_job(self, job_id):
         pass
 
+
+class WorkerBee(Bee, Thread):
+    """The thread that does the actual job processing"""
+
+    EXCHANGE = 'b.direct'
+
+    def __init__(self, options, job_queue, stats, scheduler=None, job_slots=None):
+        Thread.__init__(self)
+        Bee.__init__(self, options, stats, job_slots)
+
+        self.job_queue = job_queue
+
+        # Set once prepare() is done.
+        self.ready = Event()
+
+        if scheduler:
+            self.wait_until = scheduler.wait_until
+        else:
+            self.wait_until = None
+
+    def process_message(self, message):
+        if message.type == Message.STOP:
+            return True
+        elif message.type == Message.JOB:
+            # A job that raises is reported and counted as an error, and the
+            # thread goes on to the next one.
+            try:
+                run_sync(self.run_job(message), self.wait_until)
+            except Exception, e:
+                traceback.print_exc()
+                self.error("uncaught %s" % e.__class__.__name__)
+            finally:
+                if self.job_slots:
+                    self.job_slots.release()
+
     def run(self):
-        while True:
-            done = self.process_message(self.job_queue.get())
+        try:
+            try:
+                run_sync(self.prepare(), self.wait_until)
+            finally:
+                self.ready.set()
+
+            while True:
+                done = self.process_message(self.job_queue.get())
+
+                if done:
+                    break
+        finally:
+            self.job_queue.remove_reader()
+
+
+class AsyncWorkerBee(Bee):
+    """Runs jobs as coroutines on an EventLoop (--engine async).
+
+    Each worker process creates --threads AsyncWorkerBees, and each runs one
+    job at a time.  Protocol methods must never block.  Instead, they should
+    be coroutines that wait using the helpers in tools.eventloop.
+    """
+
+    def __init__(self, options, loop, stats, job_slots=None):
+        super(AsyncWorkerBee, self).__init__(options, stats, job_slots)
+
+        self.loop = loop
+
+
+class StatsBuffer(object):
+    """Collects a worker process's stats and sends them on as snapshots.
+
+    Sending a message for every tally, level change and series value would
+    mean several messages per request for the StatsGatherer to unpickle.
+    Instead, a StatsBuffer counts tallies, keeps a time-weighted Level of its
+    own for each level, and collects series values in Histograms.  A thread
+    sends all of that as one STAT_SNAPSHOT message every flush_interval
+    seconds, so the StatsGatherer's work grows with the number of worker
+    processes rather than with the request rate.
+
+    Given ShmCounters, it also hands out rows of shared-memory counters for
+    Bees to count tallies in, and sends the names of new counters with each
+    snapshot.
+
+    It's safe to use from any thread in the process.
+    """
+
+    def __init__(self, stats_queue, relative_error, flush_interval, source=0, counters=None):
+        self._queue = stats_queue
+        self._relative_error = relative_error
+        self._flush_interval = flush_interval
+        self._source = source
+        self._registry = counters.registry(source) if counters else None
+        self._lock = Lock()
+        self._levels = {}
+        self._tallies = defaultdict(int)
+        self._series = {}
+        self._breakdowns = {}
+        self._stopped = Event()
+        self._thread = None
+
+    def tally(self, name, count=1):
+        with self._lock:
+            self._tallies[name] += count
+
+    def level(self, name, direction):
+        with self._lock:
+            level = self._levels.get(name)
+
+            if level is None:
+                level = self._levels[name] = Level()
+
+            level.add(direction)
+
+    def series(self, name, value):
+        with self._lock:
+            histogram = self._series.get(name)
+
+            if histogram is None:
+                histogram = self._series[name] = Histogram(self._relative_error)
+
+            histogram.add(value)
+
+    def breakdown(self, name, key, value):
+        with self._lock:
+            histograms = self._breakdowns.setdefault(name, {})
+            histogram = histograms.get(key)
+
+            if histogram is None:
+                histogram = histograms[key] = Histogram(self._relative_error)
+
+            histogram.add(value)
+
+    def take_row(self):
+        """Return a CounterRow for one thread to count tallies in, or None."""
+
+        if self._registry:
+            return self._registry.take_row()
+
+    def release_row(self, row):
+        if row:
+            self._registry.release_row(row)
+
+    def put(self, message):
+        """Take a stat Message, as would be sent to the stats queue."""
+
+        if message.type == Message.STAT_TALLY:
+            self.tally(message.body)
+        elif message.type == Message.STAT_LEVEL:
+            self.level(*message.body)
+        elif message.type == Message.STAT_SERIES:
+            self.series(*message.body)
+        else:
+            self._queue.put(message)
+
+    def flush(self):
+        """Send everything collected since the last flush."""
+
+        with self._lock:
+            tallies, self._tallies = self._tallies, defaultdict(int)
+            series, self._series = self._series, {}
+            breakdowns, self._breakdowns = self._breakdowns, {}
+            levels = dict((name, level.snapshot()) for name, level in self._levels.iteritems())
+
+        slot_names = self._registry.new_names() if self._registry else {}
+
+        if tallies or levels or series or breakdowns or slot_names:
+            self._queue.put(Message(Message.STAT_SNAPSHOT,
+                                    (self._source, dict(tallies), levels, series, breakdowns, slot_names)))
+
+    def start(self):
+        self._thread = Thread(target=self._run)
+        self._thread.setDaemon(True)
+        self._thread.start()
+
+    def stop(self):
+        """Stop the flushing thread, after one last flush."""
+
+        self._stopped.set()
+        self._thread.join()
+
+    def _run(self):
+        while not self._stopped.wait(self._flush_interval):
+            self.flush()
+
+        self.flush()
+
+
+class _Waiter(object):
+    """A WorkerBee waiting in a LocalJobQueue."""
+
+    def __init__(self):
+        self.message = None
+        self.lock = Lock()
+        self.lock.acquire()
+        self.thread = current_thread()
+        self.idle_since = None
+
+
+class LocalJobQueue(object):
+    """Passes jobs from a WorkerBeeProcess's feeder thread to its WorkerBees.
+
+    Idle WorkerBees wait in a deque, each blocked on a lock of its own, and
+    the feeder hands each job directly to the longest-waiting one.  The feeder
+    waits on a condition variable until at least one WorkerBee is idle, so
+    that it only takes jobs off the shared job queue when a thread in this
+    process is free to run them.  Otherwise, jobs could pile up here behind
+    busy threads while other processes sit idle.
+
+    Jobs only queue up here when the feeder receives more of them at once than
+    there are idle WorkerBees, as with --batch-window, or with spare jobs (see
+    WorkerBeeProcess).  If stats (a StatsBuffer) is given, the number of jobs
+    queued up here is reported as the level "Jobs Waiting for a Thread".
+
+    The WorkerBeeProcess counts each WorkerBee in with add_reader() before
+    starting it, and each counts itself out with remove_reader() as its
+    thread ends, so that the feeder can tell when none are left.
+    """
+
+    def __init__(self, spare_jobs=0, stats=None):
+        self._jobs = deque()
+        self._idle = deque()
+        self._readers = 0
+        self._lock = Lock()
+        self._reader_ready = Condition(self._lock)
+        self._waiters = local()
+        self._spare_jobs = spare_jobs
+        self._stats = stats
+
+    def put(self, messages):
+        with self._lock:
+            for message in messages:
+                if self._idle:
+                    waiter = self._idle.popleft()
+                    waiter.message = message
+                    waiter.lock.release()
+                else:
+                    self._jobs.append(message)
+                    self._waiting(message, '+')
+
+    def get(self):
+        try:
+            waiter = self._waiters.waiter
+        except AttributeError:
+            waiter = self._waiters.waiter = _Waiter()
+
+        with self._lock:
+            if self._jobs:
+                message = self._jobs.popleft()
+                self._waiting(message, '-')
+                self._reader_ready.notify()
+                return message
+
+            waiter.idle_since = time.time()
+            self._idle.append(waiter)
+            self._reader_ready.notify()
+
+        # put() releases our lock once it has given us a message.
+        waiter.lock.acquire()
+
+        return waiter.message
+
+    def wait_for_readers(self):
+        """Block until there's room for a job.
+
+        There's room if a WorkerBee is idle, or if fewer than spare_jobs jobs
+        are queued up waiting for one.  Returns the number of jobs there's
+        room for, or 0 if every WorkerBee's thread has ended.
+        """
+
+        with self._lock:
+            while self._readers and len(self._idle) + self._spare_jobs <= len(self._jobs):
+                self._reader_ready.wait()
+
+            if not self._readers:
+                return 0
+
+            return len(self._idle) + self._spare_jobs - len(self._jobs)
+
+    def add_reader(self):
+        with self._lock:
+            self._readers += 1
+
+    def remove_reader(self):
+        with self._lock:
+            self._readers -= 1
+            self._reader_ready.notify()
+
+    def clear(self):
+        """Remove and return the messages queued up here."""
+
+        with self._lock:
+            messages = list(self._jobs)
+            self._jobs.clear()
+
+            for message in messages:
+                self._waiting(message, '-')
+
+        return messages
+
+    def idle(self):
+        """Return the number of idle WorkerBees."""
+
+        return len(self._idle)
+
+    def retire_idle(self, idle_time, limit):
+        """Stop up to limit WorkerBees that have been idle for idle_time seconds.
+
+        Returns their threads.
+        """
+
+        retired = []
+        cutoff = time.time() - idle_time
+
+        with self._lock:
+            # The longest-idle WorkerBees are at the front.
+            while self._idle and len(retired) < limit and self._idle[0].idle_since < cutoff:
+                waiter = self._idle.popleft()
+                waiter.message = Message(Message.STOP)
+                waiter.lock.release()
+                retired.append(waiter.thread)
+
+        return retired
+
+    def _waiting(self, message, direction):
+        if self._stats and message.type == Message.JOB:
+            self._stats.level("Jobs Waiting for a Thread", direction)
+
+
+class ShmJobQueue(object):
+    """The QueenBee's end of a set of ShmRings, used in place of a Queue.
+
+    Each job goes to whichever of the QueenBee's rings has the fewest jobs
+    waiting in it.  STOP messages go to each ring in turn, so that sending one
+    per worker stops them all, just as with a shared Queue.
+    """
+
+    def __init__(self, rings, ring_nums):
+        self._rings = rings
+        self._ring_nums = numpy.array(ring_nums)
+        self._next_stop = 0
+
+    def put(self, message):
+        if message.type == Message.JOB:
+            start_time, job_id, job_file, offset, length, copy, loop = message.body
+            records = [(Message.JOB, copy, length, start_time, job_key(job_id), offset, loop)]
+        elif message.type == Message.JOB_BATCH:
+            start_time, job_file, jobs = message.body
+            records = [(Message.JOB, copy, length, start_time, job_key(job_id), offset, loop)
+                       for job_id, offset, length, copy, loop in jobs]
+        elif message.type == Message.STOP:
+            ring = self._ring_nums[self._next_stop % len(self._ring_nums)]
+            self._next_stop += 1
+            self._rings.put(ring, [(Message.STOP, 0, 0, 0, 0, 0, 0)])
+            return
+        else:
+            raise ValueError("can't send %s through shared memory" % message)
+
+        self._rings.put(self._rings.least_loaded(self._ring_nums), records)
+
+    def cancel_join_thread(self):
+        pass
+
+
+class ShmJobReader(object):
+    """A worker's end of one of a set of ShmRings, used in place of a Queue."""
+
+    def __init__(self, rings, ring_num, job_file):
+        self._rings = rings
+        self._ring_num = ring_num
+        self._job_file = job_file
+
+    def get(self, block=True):
+        type, copy, length, start_time, job_id, offset, loop = self._rings.get(self._ring_num, block)
+
+        if type == Message.STOP:
+            return Message(Message.STOP)
+        else:
+            return Message(Message.JOB, (start_time, job_id, self._job_file, offset, length, copy, loop))
+
+    def get_nowait(self):
+        return self.get(False)
+
+
+class AsyncJobQueue(object):
+    """Passes jobs from a WorkerBeeProcess's feeder thread to its EventLoop.
+
+    This stands in for a LocalJobQueue with --engine async.  An idle
+    AsyncWorkerBee plays the part of an idle thread.
+    """
+
+    def __init__(self, loop, bees):
+        self._loop = loop
+        self._idle = list(bees)
+        self._backlog = deque()
+        self._running = 0
+        self._stopping = False
+
+        # The number of AsyncWorkerBees that will be idle once the jobs
+        # already given to the loop have started.  Shared with the feeder.
+        self._available = len(bees)
+        self._lock = Lock()
+        self._reader_ready = Condition(self._lock)
+
+    def put(self, messages):
+        jobs = sum(1 for message in messages if message.type != Message.STOP)
+
+        with self._lock:
+            self._available -= jobs
+
+        self._loop.call_soon_threadsafe(self._receive, messages)
+
+    def wait_for_readers(self):
+        """Block until at least one AsyncWorkerBee is available.
+
+        Returns the number of available AsyncWorkerBees.
+        """
+
+        with self._lock:
+            while self._available <= 0:
+                self._reader_ready.wait()
+
+            return self._available
+
+    # The rest runs in the loop's thread.
+
+    def _receive(self, messages):
+        for message in messages:
+            if message.type == Message.STOP:
+                self._stopping = True
+            else:
+                self._backlog.append(message)
+
+        self._start_jobs()
+
+    def _start_jobs(self):
+        while self._backlog and self._idle:
+            bee = self._idle.pop()
+            self._running += 1
+            self._loop.spawn(bee.run_job(self._backlog.popleft()),
+                             lambda bee=bee: self._job_done(bee))
+
+        if self._stopping and not self._running and not self._backlog:
+            self._loop.stop()
+
+    def _job_done(self, bee):
+        if bee.job_slots:
+            bee.job_slots.release()
+
+        self._idle.append(bee)
+        self._running -= 1
+
+        with self._lock:
+            self._available += 1
+            self._reader_ready.notify()
+
+        self._start_jobs()
 
-            if done:
-                break
 
 class WorkerBeeProcess(ChildProcess):
-    """Manages the set of WorkerBee threads"""
+    """Manages the set of WorkerBee threads
 
-    def __init__(self, options, protocol, job_queue, stats_queue):
+    A single feeder thread reads the shared job queue and hands jobs to the
+    WorkerBees through a LocalJobQueue, so that only one thread per process
+    contends for the shared queue.
+
+    With --max-threads, the pool of WorkerBee threads is elastic.  The feeder
+    takes one job more than there are idle threads, and a job that starts late
+    while no thread is idle adds a thread, up to --max-threads.  Threads that
+    sit idle for --thread-idle-timeout seconds are stopped, down to --threads.
+    """
+
+    def __init__(self, options, protocol, job_queue, stats_queue, job_slots=None, ready_queue=None,
+                 queued_jobs=None, counters=None, worker_num=0):
         super(WorkerBeeProcess, self).__init__()
 
         self.options = options
@@ -423,29 +1724,264 @@ class WorkerBeeProcess(ChildProcess):
         self.threads = []
         self.job_queue = job_queue
         self.stats_queue = stats_queue
+        self.job_slots = job_slots
+        self.ready_queue = ready_queue
+        self.queued_jobs = queued_jobs
+        self.counters = counters
+        self.worker_num = worker_num
+        self.elastic = options.max_threads > options.threads
+
+        # Guards self.threads once the pool is running.
+        self._pool_lock = Lock()
+        self._stopping = False
+
+        # The process is started right after it's created, so this is when
+        # spawning it began.
+        self._created = time.time()
+
+    def report_ready(self, started, bees_started):
+        """Tell the BeeKeeper this process is ready, and how long it took."""
+
+        if self.ready_queue:
+            self.ready_queue.put([('spawn', started - self._created),
+                                  ('threads', bees_started - started),
+                                  ('warmup', time.time() - bees_started)])
+
+    def feed(self, local_queue):
+        """Move jobs from the shared job queue to the local one."""
+
+        while True:
+            readers = local_queue.wait_for_readers()
+
+            if not readers:
+                self.discard_jobs(local_queue)
+                break
+
+            # Wait for one message, then take as many more as there are idle
+            # WorkerBees if they're already available.
+            messages = [self.job_queue.get()]
+
+            while len(messages) < readers and messages[-1].type != Message.STOP:
+                try:
+                    messages.append(self.job_queue.get_nowait())
+                except Empty:
+                    break
+
+            jobs = []
+
+            for message in messages:
+                if message.type == Message.JOB_BATCH:
+                    start_time, job_file, batch = message.body
+
+                    jobs.extend(Message(Message.JOB, (start_time, job_id, job_file, offset, length, copy, loop))
+                                for job_id, offset, length, copy, loop in batch)
+                elif message.type == Message.STOP:
+                    jobs.extend([message] * self.stop_pool())
+                else:
+                    jobs.append(message)
+
+            if self.queued_jobs:
+                received = sum(1 for job in jobs if job.type == Message.JOB)
+
+                with self.queued_jobs.get_lock():
+                    self.queued_jobs.value -= received
+
+            local_queue.put(jobs)
+
+            if messages[-1].type == Message.STOP:
+                break
+
+    def discard_jobs(self, local_queue):
+        """Throw jobs away until the STOP, once every WorkerBee has died.
+
+        The QueenBee may be waiting for job slots or for the queue to drain, so
+        the jobs are still taken off the shared job queue and accounted for.
+        Otherwise the run, and the BeeKeeper waiting on this process, would
+        never finish.
+        """
+
+        sys.stderr.write("worker %d: no WorkerBee threads left, discarding jobs\n" % self.worker_num)
+
+        received = len([message for message in local_queue.clear() if message.type == Message.JOB])
+        discarded = 0
+
+        while True:
+            # Each job's slot must be released straight away, or a QueenBee
+            # waiting for one would never send the STOP.
+            if self.job_slots:
+                for i in xrange(received):
+                    self.job_slots.release()
+
+            discarded += received
+
+            message = self.job_queue.get()
+
+            if message.type == Message.STOP:
+                break
+
+            if message.type == Message.JOB_BATCH:
+                received = len(message.body[2])
+            else:
+                received = 1
+
+            if self.queued_jobs:
+                with self.queued_jobs.get_lock():
+                    self.queued_jobs.value -= received
+
+        self.stats.tally("Jobs Discarded", discarded)
 
     def run_child_process(self):
+        started = time.time()
+
+        self.stats = StatsBuffer(self.stats_queue, self.options.histogram_error,
+                                 self.options.stats_flush_interval / 1000.0,
+                                 self.worker_num, self.counters)
+        self.stats.start()
+
+        try:
+            if self.options.engine == 'async':
+                self.run_event_loop(started)
+            else:
+                self.run_threads(started)
+        finally:
+            self.stats.stop()
+
+    def run_threads(self, started):
+        if self.elastic:
+            self.local_queue = LocalJobQueue(1, self.stats)
+        else:
+            self.local_queue = LocalJobQueue()
+
+        self.scheduler = Scheduler(self.options.spin_time / 1000000.0)
+
         delay = self.options.stagger_threads / 1000.0
         for i in xrange(self.options.threads):
-            thread = self.protocol.WorkerBee(self.options, self.job_queue, self.stats_queue)
-            thread.setDaemon(True)
-            thread.start()
-            self.threads.append(thread)
+            with self._pool_lock:
+                self.add_thread()
             time.sleep(delay)
 
         debug("spawned %d threads" % len(self.threads))
 
+        # The feeder gives up on the pool once no WorkerBees are left, so it
+        # mustn't start before the first one is counted in.
+        feeder = Thread(target=self.feed, args=(self.local_queue,))
+        feeder.setDaemon(True)
+        feeder.start()
+
+        threads_started = time.time()
+
+        for thread in list(self.threads):
+            thread.ready.wait()
+
+        self.report_ready(started, threads_started)
+
+        if self.elastic:
+            manager = Thread(target=self.manage_pool)
+            manager.setDaemon(True)
+            manager.start()
+
+        # Once the feeder has passed on the STOP, the pool stops changing.  It
+        # also returns if every WorkerBee has died, after discarding the rest
+        # of the jobs.
+        feeder.join()
+
         for thread in self.threads:
             thread.join()
 
         debug('worker ended')
 
+    def add_thread(self):
+        """Start a WorkerBee thread.  Call with _pool_lock held."""
+
+        thread = self.protocol.WorkerBee(self.options, self.local_queue, self.stats,
+                                         self.scheduler, self.job_slots)
+        thread.setDaemon(True)
+        thread.counters = self.stats.take_row()
+
+        if self.elastic:
+            thread.late_start_hook = self.grow_pool
+            self.stats.level("Worker Threads", "+")
+
+        self.local_queue.add_reader()
+        thread.start()
+        self.threads.append(thread)
+
+    def grow_pool(self):
+        """Add a thread if every thread is busy, up to --max-threads."""
+
+        with self._pool_lock:
+            if (not self._stopping and len(self.threads) < self.options.max_threads and
+                    not self.local_queue.idle()):
+                self.add_thread()
+
+    def manage_pool(self):
+        """Stop threads that have been idle too long, down to --threads."""
+
+        while True:
+            time.sleep(1)
+
+            with self._pool_lock:
+                if self._stopping:
+                    break
+
+                retired = self.local_queue.retire_idle(self.options.thread_idle_timeout,
+                                                           len(self.threads) - self.options.threads)
+
+                for thread in retired:
+                    self.threads.remove(thread)
+                    self.stats.release_row(thread.counters)
+                    self.stats.level("Worker Threads", "-")
+
+    def stop_pool(self):
+        """Stop the pool from changing, and return how many STOPs to send."""
+
+        with self._pool_lock:
+            self._stopping = True
+
+            return len(self.threads) or self.options.threads
+
+    def run_event_loop(self, started):
+        loop = EventLoop(self.options.spin_time / 1000000.0)
+        bees = [self.protocol.AsyncWorkerBee(self.options, loop, self.stats, self.job_slots)
+                for i in xrange(self.options.threads)]
+        job_queue = AsyncJobQueue(loop, bees)
+
+        # The bees all run in the event loop's thread, so they can share a
+        # row of counters.
+        counters = self.stats.take_row()
+
+        for bee in bees:
+            bee.counters = counters
+
+        bees_started = time.time()
+        preparing = [len(bees)]
+
+        def bee_ready():
+            preparing[0] -= 1
+
+            if not preparing[0]:
+                self.report_ready(started, bees_started)
+
+        for bee in bees:
+            loop.spawn(bee.prepare(), bee_ready)
+
+        feeder = Thread(target=self.feed, args=(job_queue,))
+        feeder.setDaemon(True)
+        feeder.start()
+
+        loop.run()
+
+        debug('worker ended')
+
 class Message (object):
     STOP = 3
     JOB = 8
     STAT_TALLY = 9
     STAT_LEVEL = 10
     STAT_SERIES = 11
+    JOB_BATCH = 12
+    STAT_SNAPSHOT = 13
+    PHASE = 14
 
     def __init__(self, type, body=None):
         self.type = type
@@ -471,6 +2007,19 @@ def add_options(parser):
     parser.add_option('--asap',
                       action='store_true', default=False,
                       help='send queries as fast as possible (default: off)')
+    parser.add_option('--concurrency', metavar='N',
+                      default=0, type='int',
+                      help='''Closed-loop mode: ignore when each job was captured and
+                           instead keep exactly N jobs running at once, starting a
+                           new job as soon as one finishes.  Prints the achieved
+                           request rate and latency percentiles at the end.
+                           Requires at least N --workers times --threads.
+                           (default: 0, replay jobs at their captured times)''')
+    parser.add_option('--think-time', default='keep', choices=('keep', 'drop'),
+                      help='''With --concurrency, whether to keep the captured gaps
+                           between requests within a job (scaled by --speedup) or
+                           drop them and send each request as soon as the previous
+                           one completes.  (default: %default)''')
     parser.add_option('-w', '--workers', metavar='N',
                       default=100, type='int',
                       help='number of worker bee processes (default: 100)')
@@ -479,21 +2028,109 @@ def add_options(parser):
                       help='number of milliseconds to wait between starting workers (default: 0)')
     parser.add_option('-t', '--threads', metavar='N',
                       default=1, type='int',
-                      help='number of threads per worker process (default: 1)')
+                      help='''number of threads per worker process.  With --engine async,
+                           the number of jobs each worker process may run at once.
+                           (default: 1)''')
+    parser.add_option('--auto-size', action='store_true', default=False,
+                      help='''Choose --workers and --threads from the most jobs that run
+                           at once, with the chosen --sample-rate, --start-at and so
+                           on, plus --auto-size-headroom.  Uses at least one worker
+                           per CPU.  Fast with a binary index.''')
+    parser.add_option('--auto-size-headroom', metavar='PERCENT', default=20, type='int',
+                      help='''Extra threads to allow for with --auto-size.
+                           (default: %default)''')
+    parser.add_option('--max-threads', metavar='N', default=0, type='int',
+                      help='''Let each worker process start more threads, up to N, when
+                           jobs start late because all of its threads are busy.
+                           --threads is then the minimum.  (default: a fixed pool of
+                           --threads)''')
+    parser.add_option('--thread-idle-timeout', metavar='SECONDS', default=30.0, type='float',
+                      help='''With --max-threads, stop threads beyond --threads once
+                           they've been idle this long.  (default: %default)''')
+    parser.add_option('--engine', default='thread', choices=('thread', 'async'),
+                      help='''How worker processes run jobs: thread (a thread per running
+                           job) or async (a coroutine per running job, all on one
+                           event loop).  async allows far more concurrent jobs, but
+                           isn't available for protocols with blocking client
+                           libraries, such as mysql.  (default: %default)''')
+    parser.add_option('--queens', metavar='N',
+                      default=1, type='int',
+                      help='''number of QueenBee processes sending jobs.  Each sends
+                           its own share of the jobs file to its own share of
+                           the workers. (default: 1)''')
+    parser.add_option('--transport', default='queue', choices=('queue', 'shm'),
+                      help='''How the QueenBee sends jobs to worker processes:
+                           queue (a multiprocessing Queue) or shm (a ring buffer in
+                           shared memory for each worker process, which avoids
+                           system calls and pickling).  (default: %default)''')
+    parser.add_option('--shm-slots', default=16384, type='int', metavar='NUM',
+                      help='''Number of jobs each worker's ring buffer can hold with
+                           --transport shm.  (default: %default)''')
     parser.add_option('--stagger-threads', metavar='MSEC',
                       default=0, type='int',
                       help='number of milliseconds to wait between starting threadss (default: 0)')
     parser.add_option('--startup-wait', metavar='SEC',
                       default=0, type='int',
-                      help='number of seconds to wait after starting all workers before enqueuing jobs (default: 0)')
+                      help='number of seconds to wait after all workers are ready before enqueuing jobs (default: 0)')
+    parser.add_option('--warm-connections', action='store_true', default=False,
+                      help='''Before the run starts, have every WorkerBee open a
+                           connection (through its protocol's warmup() hook) for its
+                           first job to use.''')
     parser.add_option('--speedup', default=1.0, dest='speedup', type='float',
                       help="Time multiple used when replaying query logs.  2.0 means "
                            "that queries run twice as fast (and the entire run takes "
                            "half the time the capture ran for).")
+    parser.add_option('--load-profile', metavar='FILE',
+                      help='''Vary the speedup over the course of the run according to
+                           FILE, which lists segments such as "10m 1" (1x for 10
+                           minutes) and "5m ramp 4" (speed up steadily to 4x over 5
+                           minutes).  See apiary/tools/timemap.py for the format.
+                           Overrides --speedup.''')
+    parser.add_option('--warmup', default=0.0, type='float', metavar='SECONDS',
+                      help='''Treat the first SECONDS of the capture (after --start-at) as
+                           a warmup: its stats are reported separately from the
+                           measured part of the run.  (default: no warmup)''')
+    parser.add_option('--warmup-speedup', type='float', metavar='X',
+                      help='''Replay the warmup at this speedup instead of --speedup (or
+                           the start of --load-profile).  Use a large value to warm up
+                           as fast as the workers can go.''')
+    parser.add_option('--cooldown', default=0.0, type='float', metavar='SECONDS',
+                      help='''Treat the last SECONDS of the capture (before --stop-at,
+                           or the end of the last loop or of --duration) as a
+                           cooldown, reported separately.  (default: no cooldown)''')
+    parser.add_option('--start-at', default=0.0, type='float', metavar='SECONDS',
+                      help='''Start with the first job that starts this many seconds
+                           into the capture.  The run begins immediately, as if the
+                           capture began at this point.  Fast with a binary index
+                           (see gen-jobs-index).  (default: %default)''')
+    parser.add_option('--stop-at', type='float', metavar='SECONDS',
+                      help='''Don't run jobs that start this many seconds or more into
+                           the capture.  (default: run to the end)''')
+    parser.add_option('--loop', type='int', metavar='N',
+                      help='''Replay the capture (or the part between --start-at and
+                           --stop-at) N times, one after another, or until --duration
+                           if N is 0.  (default: 1, or 0 with --duration)''')
+    parser.add_option('--duration', type='float', metavar='SECONDS',
+                      help='''Stop sending jobs after this many seconds of run time.
+                           Unless --loop is given, the capture repeats as many times
+                           as it takes to fill the time.''')
+    parser.add_option('--sample-rate', default=1.0, type='float', metavar='FRACTION',
+                      help='''Run this fraction of the jobs, chosen by a hash of the
+                           job ID.  The same jobs are chosen on every run.
+                           (default: %default)''')
+    parser.add_option('--sample-seed', default=0, type='int', metavar='NUM',
+                      help='''Seed for the hash that chooses jobs with --sample-rate,
+                           --slice and --skip.  Change it to choose a different set
+                           of jobs.  (default: %default)''')
+    parser.add_option('--slice', default='0/1', metavar='I/N',
+                      help='''Run only the Ith of N disjoint slices of the jobs, chosen
+                           by a hash of the job ID.  For example, run apiary on three
+                           hosts with --slice 0/3, 1/3 and 2/3 to split the load
+                           between them.  (default: %default)''')
     parser.add_option('--skip', default=0, type='int', metavar='NUM',
-                      help='''Skip this many jobs before running a job.  For example,
-                           a value of 31 would skip 31 jobs, run one, skip 31, etc, so
-                           1 out of every 32 jobs would be run.''')
+                      help='''Run 1 out of every NUM + 1 jobs.  For example, a value of
+                           31 would run 1 out of every 32 jobs.  Jobs are chosen by a
+                           hash of the job ID, as with --sample-rate.''')
     parser.add_option('--ramp-time', default=0, type='int', metavar='SECONDS',
                       help='''After this number of seconds, decrement the --skip
                            by 1.  Continue in this way until --skip reaches
@@ -507,9 +2144,58 @@ def add_options(parser):
                               1 to run all jobs.''')
     parser.add_option('--max-ahead', default=300, type='int', metavar='SECONDS',
                       help='''How many seconds ahead the QueenBee may get in sending
-                           jobs to the queue.  Only change this if apiary consumes tpp
-                           much memory''')
+                           jobs to the queue.  (default: %default)''')
+    parser.add_option('--max-queued', default=50000, type='int', metavar='JOBS',
+                      help='''Hold back jobs while this many are waiting in the job
+                           queues for a worker to take them, unless they're due to
+                           start.  Lower this if apiary consumes too much memory.
+                           0 means no limit.  (default: %default)''')
+    parser.add_option('--spin-time', default=250, type='int', metavar='USEC',
+                      help='''Sleep until this many microseconds before each request
+                           is due, then busy-wait until it's time to send it.
+                           Waking from sleep takes long enough to throw off request
+                           timing at high --speedup.  Higher values improve
+                           accuracy but use more CPU.  (default: %default)''')
+    parser.add_option('--amplify', default=1, type='int', metavar='K',
+                      help='''Run each job K times, to generate more load than was
+                           captured without changing the timing of each client.
+                           See also --rewrite.  (default: %default)''')
+    parser.add_option('--amplify-jitter', default=100, type='float', metavar='MSEC',
+                      help='''Start each extra copy of a job up to this many
+                           milliseconds after the original.  (default: %default)''')
+    parser.add_option('--rewrite', nargs=2, action='append', metavar='REGEX REPLACEMENT',
+                      help='''In copies of jobs made by --amplify, replace matches of
+                           REGEX in each request with REPLACEMENT, which may refer to
+                           groups as in re.sub().  {copy} in REPLACEMENT stands for
+                           the copy number; write a group just before it as
+                           \\g<1>{copy}, since \\1{copy} would mean group 11.  May
+                           be given more than once.''')
+    parser.add_option('--rewrite-hook', metavar='MODULE:FUNCTION',
+                      help='''In copies of jobs made by --amplify, pass each request
+                           through FUNCTION(request, copy), imported from MODULE, and
+                           send what it returns.  Applied after --rewrite.''')
+    parser.add_option('--batch-window', default=0, type='float', metavar='MSEC',
+                      help='''Send jobs that start within this many milliseconds of
+                           each other (after --speedup is applied) to the workers
+                           as a single message.  This takes load off the job queue
+                           at high job rates.  (default: 0, one job per message)''')
+    parser.add_option('--batch-size', default=0, type='int', metavar='NUM',
+                      help='''Maximum number of jobs in a batch when using
+                           --batch-window.  All jobs in a batch go to the same
+                           worker process.  (default: --threads)''')
     parser.add_option('-n', '--dry-run', default=False, action='store_true',
                       help='''Don't actually send any requests.''')
     parser.add_option('-i', '--stats-interval', type=int, default=15, metavar='SECONDS',
                       help='''How often to report statistics, in seconds. (default: %default)''')
+    parser.add_option('--stats-flush-interval', type=int, default=100, metavar='MS',
+                      help='''How often each worker process sends the statistics it has
+                           collected to be reported, in milliseconds.
+                           (default: %default)''')
+    parser.add_option('--breakdown-size', type=int, default=20, metavar='N',
+                      help='''How many keys to print for each breakdown, such as the
+                           per-query stats from --mysql-fingerprints, at the end
+                           of the run or on SIGUSR1.  (default: %default)''')
+    parser.add_option('--histogram-error', type='float', default=0.01, metavar='FRACTION',
+                      help='''Largest relative error of the percentiles reported for
+                           series statistics such as Request Duration.  Smaller
+                           values take more memory.  (default: %default)''')
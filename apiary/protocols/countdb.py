@@ -12,6 +12,8 @@ import socket
 import sys
 import apiary
 import optparse
+from apiary.tools import eventloop
+from apiary.tools.eventloop import Return
 
 class CountDBWorkerBee(apiary.WorkerBee):
     """A WorkerBee that sends requests to CountDB"""
@@ -24,7 +26,7 @@ class CountDBWorkerBee(apiary.WorkerBee):
         self.options = options
         self.connection = None
 
-    def start_job(self, job_id):
+    def _connect(self):
         socket.setdefaulttimeout(self.options.countdb_timeout)
 
         try:
@@ -34,6 +36,14 @@ class CountDBWorkerBee(apiary.WorkerBee):
             self.error("error while connecting: %s" % e)
             self.connection = None
 
+    def warmup(self):
+        self._connect()
+
+    def start_job(self, job_id):
+        # The first job may have a connection from warmup().
+        if not self.connection:
+            self._connect()
+
     def send_request(self, request):
         if self.connection:
             try:
@@ -54,7 +64,63 @@ class CountDBWorkerBee(apiary.WorkerBee):
 
         self.connection = None
 
+class AsyncCountDBWorkerBee(apiary.AsyncWorkerBee):
+    """An AsyncWorkerBee that sends requests to CountDB"""
+
+    def __init__(self, options, *args, **kwargs):
+        super(AsyncCountDBWorkerBee, self).__init__(options, *args, **kwargs)
+
+        self.countdb_host = socket.gethostbyname(options.countdb_host)
+
+        self.options = options
+        self.connection = None
+
+    def _connect(self):
+        try:
+            self.connection = socket.socket()
+            self.connection.setblocking(0)
+            yield eventloop.connect(self.connection,
+                                    (self.countdb_host, self.options.countdb_port),
+                                    self.options.countdb_timeout)
+        except Exception, e:
+            self.error("error while connecting: %s" % e)
+            self._close()
+
+    def warmup(self):
+        yield self._connect()
+
+    def start_job(self, job_id):
+        if not self.connection:
+            yield self._connect()
+
+    def send_request(self, request):
+        if self.connection:
+            try:
+                yield eventloop.sendall(self.connection, "json %s\0" % request,
+                                        self.options.countdb_timeout)
+                yield eventloop.recv(self.connection, self.options.countdb_recv_size,
+                                     self.options.countdb_timeout)
+            except Exception, e:  # TODO: more restrictive error catching?
+                self.error("error while sending request and reading response: %s" % e)
+            else:
+                raise Return(True)
+
+        raise Return(False)
+
+    def finish_job(self, job_id):
+        self._close()
+
+    def _close(self):
+        if self.connection:
+            try:
+                self.connection.close()
+            except:
+                pass
+
+        self.connection = None
+
 WorkerBee = CountDBWorkerBee
+AsyncWorkerBee = AsyncCountDBWorkerBee
 
 
 def add_options(parser):
@@ -16,6 +16,8 @@ import optparse
 import time
 from httplib import HTTPResponse, IncompleteRead
 import threading
+from apiary.tools import eventloop
+from apiary.tools.eventloop import Return
 
 
 content_length_re = re.compile('content-length:\s+([0-9]+)\r\n', re.I | re.S)
@@ -50,11 +52,16 @@ class HTTPWorkerBee(apiary.WorkerBee):
 
         self.connection = None
 
+    def warmup(self):
+        self._connect()
+
     def start_job(self, job_id):
         self.current_job_id = job_id
         self.request_num = -1
 
-        self._connect()
+        # The first job may have a connection from warmup().
+        if not self.connection:
+            self._connect()
 
     def send_request(self, request):
         self.request_num += 1
@@ -121,12 +128,186 @@ class HTTPWorkerBee(apiary.WorkerBee):
         return True
 
     def finish_job(self, job_id):
-        if self.stats:
-            self.stats_file.flush()
+        self._disconnect()
+
+
+class AsyncHTTPWorkerBee(apiary.AsyncWorkerBee):
+    """An AsyncWorkerBee that sends HTTP Requests
+
+    httplib can't read a response without blocking, so this parses responses
+    itself.  It reads (and discards) bodies delimited by Content-Length, by
+    chunked transfer-encoding, or by the server closing the connection.
+    """
+
+    def __init__(self, options, *args, **kwargs):
+        super(AsyncHTTPWorkerBee, self).__init__(options, *args, **kwargs)
+
+        self.http_host = socket.gethostbyname(options.http_host)
+
+        self.options = options
+        self.connection = None
+        self._buffer = ''
+
+    def _connect(self):
+        try:
+            self.connection = socket.socket()
+            self.connection.setblocking(0)
+            yield eventloop.connect(self.connection, (self.http_host, self.options.http_port),
+                                    self.options.http_timeout)
+        except Exception, e:
+            self.error("error while connecting: %s" % e)
+            self._disconnect()
+
+    def _disconnect(self):
+        if self.connection:
+            try:
+                self.connection.close()
+            except:
+                pass
+
+        self.connection = None
+        self._buffer = ''
+
+    def _fill(self):
+        """Read more of the response into the buffer."""
+
+        data = yield eventloop.recv(self.connection, self.options.http_read_size,
+                                    self.options.http_timeout)
+
+        if not data:
+            raise IncompleteRead(self._buffer)
+
+        self._buffer += data
+
+    def _read_line(self):
+        while '\r\n' not in self._buffer:
+            yield self._fill()
+
+        line, self._buffer = self._buffer.split('\r\n', 1)
+
+        raise Return(line)
+
+    def _skip(self, size):
+        """Discard size bytes of the response."""
+
+        while len(self._buffer) < size:
+            size -= len(self._buffer)
+            self._buffer = ''
+            yield self._fill()
+
+        self._buffer = self._buffer[size:]
+
+    def _skip_to_close(self):
+        self._buffer = ''
+
+        while True:
+            data = yield eventloop.recv(self.connection, self.options.http_read_size,
+                                        self.options.http_timeout)
+            if not data:
+                break
+
+    def _read_response(self, method):
+        """Read a response.  Returns (status, will_close)."""
+
+        # Skip any 100 Continue responses.
+        while True:
+            while '\r\n\r\n' not in self._buffer:
+                yield self._fill()
+
+            head, self._buffer = self._buffer.split('\r\n\r\n', 1)
+            lines = head.split('\r\n')
+            version, status = lines[0].split(None, 2)[:2]
+            status = int(status)
 
+            if status != 100:
+                break
+
+        headers = {}
+        for line in lines[1:]:
+            name, _, value = line.partition(':')
+            headers[name.strip().lower()] = value.strip().lower()
+
+        connection = headers.get('connection', '')
+        if version == 'HTTP/1.0':
+            will_close = 'keep-alive' not in connection
+        else:
+            will_close = 'close' in connection
+
+        if method == 'HEAD' or status in (204, 304) or 100 <= status < 200:
+            pass
+        elif 'chunked' in headers.get('transfer-encoding', ''):
+            while True:
+                size = int((yield self._read_line()).split(';', 1)[0], 16)
+
+                if size == 0:
+                    # Skip trailers.
+                    while (yield self._read_line()):
+                        pass
+                    break
+
+                yield self._skip(size + 2)
+        elif 'content-length' in headers:
+            yield self._skip(int(headers['content-length']))
+        else:
+            yield self._skip_to_close()
+            will_close = True
+
+        raise Return((status, will_close))
+
+    def warmup(self):
+        yield self._connect()
+
+    def start_job(self, job_id):
+        if not self.connection:
+            yield self._connect()
+
+    def send_request(self, request):
+        # Sanity check: if we're sending a request with a content-length but
+        # we don't have that many bytes to send, we'll just get a 504.  Don't
+        # send it and instead report a client error.
+
+        parts = request.split('\r\n\r\n', 1)
+
+        if len(parts) > 1:
+            req, body = parts
+
+            match = content_length_re.search(req)
+            if match:
+                if len(body) < int(match.group(1)):
+                    self.error("request body of incorrect size")
+
+                    raise Return(True)
+
+        if not self.connection:
+            yield self._connect()
+
+        if self.connection:
+            try:
+                yield eventloop.sendall(self.connection, request, self.options.http_timeout)
+
+                status, will_close = yield self._read_response(request.split(' ', 1)[0])
+
+                self.tally(status)
+
+                if will_close or self.options.speedup < 0.8:
+                    # See HTTPWorkerBee.send_request().
+                    self._disconnect()
+            except IncompleteRead:
+                self.error("error while reading response: IncompleteRead (terminating job)")
+                self._disconnect()
+
+            except Exception, e:  # TODO: more restrictive error catching?
+                self.error("error while sending request and reading response: %s %s" % (type(e), e))
+                self._disconnect()
+
+        # we want to keep trying in the face of errrors
+        raise Return(True)
+
+    def finish_job(self, job_id):
         self._disconnect()
 
 WorkerBee = HTTPWorkerBee
+AsyncWorkerBee = AsyncHTTPWorkerBee
 
 
 def add_options(parser):
@@ -32,15 +32,26 @@ import re
 import random
 import socket
 import sys
+import time
 import cPickle
 import MySQLdb
 import apiary
 import optparse
 import warnings
 
+from apiary.tools.fingerprint import FingerprintCache
+
+# Fingerprint caches by size, shared by the threads of each worker process.
+_fingerprint_caches = {}
+
 
 class MySQLWorkerBee(apiary.WorkerBee):
-    """A WorkerBee that sends transactions to MySQL"""
+    """A WorkerBee that sends transactions to MySQL
+
+    With --mysql-fingerprints, the duration of each successful query is also
+    added to the "Query Duration (ms)" breakdown, by the query's fingerprint
+    (see tools.fingerprint).
+    """
 
     COMMON_ERRORS = {
                         1062: "duplicate entry for key",
@@ -62,6 +73,15 @@ class MySQLWorkerBee(apiary.WorkerBee):
         self.connection = None
         self._table_dne_re = re.compile('''\(1146, "Table '.*' doesn't exist"\)''')
 
+        if options.mysql_fingerprints:
+            size = options.mysql_fingerprint_cache
+            self.fingerprint = _fingerprint_caches.get(size)
+
+            if self.fingerprint is None:
+                self.fingerprint = _fingerprint_caches[size] = FingerprintCache(size)
+        else:
+            self.fingerprint = None
+
         if options.mysql_host.startswith('@'):
             self.dynamic_host = True
             self.dynamic_host_file = options.mysql_host[1:]
@@ -80,7 +100,7 @@ class MySQLWorkerBee(apiary.WorkerBee):
 
         super(MySQLWorkerBee, self).error(msg)
 
-    def start_job(self, job_id):
+    def _connect(self):
         if not self.debug:
             warnings.filterwarnings('ignore', category=MySQLdb.Warning)
 
@@ -97,8 +117,18 @@ class MySQLWorkerBee(apiary.WorkerBee):
             self.error(e)
             self.connection = None
 
+    def warmup(self):
+        self._connect()
+
+    def start_job(self, job_id):
+        # The first job may have a connection from warmup().
+        if not self.connection:
+            self._connect()
+
     def send_request(self, query):
         if self.connection and query:
+            started = time.time()
+
             try:
                 cursor = self.connection.cursor()
 
@@ -109,6 +139,11 @@ class MySQLWorkerBee(apiary.WorkerBee):
                 if rows:
                     cursor.fetchall()
                 cursor.close()
+
+                if self.fingerprint:
+                    self.breakdown("Query Duration (ms)", self.fingerprint(query),
+                                   (time.time() - started) * 1000)
+
                 return True
             except Exception, e:  # TODO: more restrictive error catching?
                 self.error(e)
@@ -163,4 +198,11 @@ def add_options(parser):
     g.add_option('--mysql-read-timeout',
                       default=10, type='int', metavar='SECONDS',
                       help='MySQL client read timeout (default: 10)')
+    g.add_option('--mysql-fingerprints', default=False, action='store_true',
+                      help='Report the count, total and p99 duration of each kind of query, '
+                           'by fingerprint.  See --breakdown-size.')
+    g.add_option('--mysql-fingerprint-cache',
+                      default=10000, type='int', metavar='N',
+                      help='Remember the fingerprints of about N recent queries, per worker '
+                           'process (default: %default)')
     parser.add_option_group(g)
@@ -12,6 +12,7 @@ import time
 import optparse
 from random import random, randint
 import apiary
+from apiary.tools.eventloop import Return, sleep_until
 
 class TestWorkerBee(apiary.WorkerBee):
     """A WorkerBee that sends requests to CountDB"""
@@ -30,7 +31,25 @@ class TestWorkerBee(apiary.WorkerBee):
 
         return False
 
+class AsyncTestWorkerBee(apiary.AsyncWorkerBee):
+    """An AsyncWorkerBee that pretends to send requests"""
+
+    def __init__(self, options, *args, **kwargs):
+        super(AsyncTestWorkerBee, self).__init__(options, *args, **kwargs)
+
+        self.options = options
+        self.duration_range = options.max_duration - options.min_duration
+
+    def send_request(self, request):
+        yield sleep_until(time.time() + self.options.min_duration + random() * self.duration_range)
+
+        if random() < self.options.error_probability:
+            self.error("error %s" % randint(1, 5))
+
+        raise Return(False)
+
 WorkerBee = TestWorkerBee
+AsyncWorkerBee = AsyncTestWorkerBee
 
 
 def add_options(parser):
@@ -0,0 +1,144 @@
+"""Working out how many jobs run at once, and how many threads that takes.
+
+A job runs from its first request to its last, so the number of jobs running
+at any moment is the number that have started minus the number that have
+ended.  That count only changes when a job starts or ends, and only goes up
+when one starts, so the peak is always found just after some job starts.  With
+the start and end times of every job in sorted arrays, the count at the Nth
+start is N minus a binary search for it in the end times, with no python-level
+loop over the jobs.  Jobs files are already in order of start time, so only
+the end times need sorting.
+
+The concurrency doesn't depend on --speedup or a load profile: stretching or
+squeezing time keeps the same jobs overlapping.  It does depend on which jobs
+run (--sample-rate, --slice, --skip, --start-at, --stop-at) and on --amplify.
+"""
+
+import math
+
+import numpy
+
+from apiary.tools.jobsindex import index_format, open_index, iter_index_chunks, iter_jobs
+
+# The most threads worth running in one worker process, by --engine.
+MAX_THREADS_PER_PROCESS = {'thread': 80, 'async': 1000}
+
+
+def job_times(jobs_path, start_at=0.0, stop_at=None, sampler=None):
+    """Return arrays of the start and end times of the jobs that would run.
+
+    Only jobs starting between start_at and stop_at, and chosen by sampler
+    (a JobSampler), are included.  This is quick with a binary index, but
+    otherwise reads the whole jobs file.
+    """
+
+    index_path = jobs_path + '.index'
+
+    try:
+        binary = index_format(index_path) == 'binary'
+    except IOError:
+        binary = False
+
+    if binary:
+        index = open_index(index_path)
+        start_times = index['start_time']
+
+        begin = numpy.searchsorted(start_times, start_at, 'left')
+
+        if stop_at is None:
+            end = len(index)
+        else:
+            end = numpy.searchsorted(start_times, stop_at, 'left')
+
+        index = index[begin:end]
+
+        if sampler is None or sampler.selects_all:
+            return numpy.array(index['start_time']), numpy.array(index['end_time'])
+
+        chunks = list(iter_index_chunks(index, sampler.filter_index))
+
+        if not chunks:
+            return numpy.zeros(0), numpy.zeros(0)
+
+        return (numpy.concatenate([chunk['start_time'] for chunk in chunks]),
+                numpy.concatenate([chunk['end_time'] for chunk in chunks]))
+
+    jobs = []
+
+    with open(jobs_path, 'rb') as jobs_file:
+        for offset, length, (job_id, tasks) in iter_jobs(jobs_file):
+            if not tasks:
+                continue
+
+            start_time = tasks[0][0]
+
+            if stop_at is not None and start_time >= stop_at:
+                break
+
+            if start_time >= start_at:
+                jobs.append((job_id, start_time, tasks[-1][0]))
+
+    if sampler is not None:
+        jobs = list(sampler.filter_jobs(iter(jobs)))
+
+    times = numpy.array([job[1:] for job in jobs], dtype=numpy.float64).reshape(-1, 2)
+
+    return times[:, 0], times[:, 1]
+
+
+def concurrency(start_times, end_times):
+    """Return (times, counts): the number of jobs running just after each start.
+
+    A job that ends at the same moment another starts isn't counted as
+    overlapping it.  Jobs that start at the same moment are counted one at a
+    time.  times is sorted.
+    """
+
+    starts = numpy.asarray(start_times)
+
+    if len(starts) and not (starts[1:] >= starts[:-1]).all():
+        starts = numpy.sort(starts)
+
+    ends = numpy.sort(end_times)
+
+    counts = numpy.arange(1, len(starts) + 1) - numpy.searchsorted(ends, starts, 'right')
+
+    return starts, counts
+
+
+def concurrency_curve(times, counts, interval):
+    """Return (interval starts, peak counts) for each interval-second span.
+
+    times and counts are as returned by concurrency().  The peak of a span
+    in which no job starts is 0.
+    """
+
+    if not len(times):
+        return numpy.zeros(0), numpy.zeros(0, dtype=counts.dtype)
+
+    origin = math.floor(times[0] / interval) * interval
+    buckets = ((times - origin) // interval).astype(numpy.int64)
+
+    # times is sorted, so each span's counts are contiguous.
+    firsts = numpy.concatenate(([0], numpy.flatnonzero(numpy.diff(buckets)) + 1))
+
+    peaks = numpy.zeros(buckets[-1] + 1, dtype=counts.dtype)
+    peaks[buckets[firsts]] = numpy.maximum.reduceat(counts, firsts)
+
+    return origin + numpy.arange(len(peaks)) * interval, peaks
+
+
+def plan_pool(peak, cpus, headroom=0.2, engine='thread'):
+    """Return (workers, threads) with room for peak jobs plus headroom.
+
+    Uses at least one worker process per CPU, and more if that would mean
+    more than MAX_THREADS_PER_PROCESS threads in each.
+    """
+
+    needed = max(1, int(math.ceil(peak * (1 + headroom))))
+    per_process = MAX_THREADS_PER_PROCESS[engine]
+
+    workers = min(needed, max(cpus, int(math.ceil(needed / float(per_process)))))
+    threads = int(math.ceil(needed / float(workers)))
+
+    return workers, threads
@@ -0,0 +1,405 @@
+"""A small event loop for running many simulated clients in one thread.
+
+Python 2 has no asyncio, so --engine async runs each job as a generator-based
+coroutine on an EventLoop instead of on a thread of its own.  A coroutine
+yields to wait for something:
+
+    yield sleep_until(when)                 resume once time.time() >= when
+    yield wait_readable(sock, timeout)      resume once sock is readable
+    yield wait_writable(sock, timeout)      resume once sock is writable
+    result = yield other_coroutine(...)     run a coroutine to completion
+
+A coroutine passes a result back to its caller with raise Return(value).
+Yielding anything else sends it straight back, so a caller can yield the result
+of a method without caring whether the method is a coroutine or a plain
+function.  A wait that times out raises socket.timeout inside the coroutine.
+
+run_sync() runs a coroutine to completion in the calling thread, blocking in
+place of each wait.  This lets thread-based WorkerBees share code with
+coroutine-based ones.
+
+The EventLoop keeps its timers in a TimerWheel (see tools.timerwheel), and
+busy-waits for the last spin seconds before each sleep_until() is due.
+"""
+
+import os
+import sys
+import errno
+import fcntl
+import select
+import socket
+import time
+import traceback
+import types
+from collections import deque
+from threading import Lock
+
+from apiary.tools.timerwheel import TimerWheel, spin_until
+
+
+class Return(Exception):
+    """Raised by a coroutine to pass a value back to its caller."""
+
+    def __init__(self, value=None):
+        super(Return, self).__init__(value)
+        self.value = value
+
+
+class sleep_until(object):
+    __slots__ = ('when',)
+
+    def __init__(self, when):
+        self.when = when
+
+
+class wait_readable(object):
+    __slots__ = ('sock', 'timeout')
+
+    def __init__(self, sock, timeout=None):
+        self.sock = sock
+        self.timeout = timeout
+
+
+class wait_writable(wait_readable):
+    __slots__ = ()
+
+
+def run_sync(coroutine, wait=None):
+    """Run a coroutine in the calling thread and return its result.
+
+    wait, if given, is called with the time of each sleep_until() and must
+    block until then.  By default, run_sync() uses time.sleep().
+    """
+
+    stack = [coroutine]
+    value = None
+    exception = None
+
+    while True:
+        try:
+            if exception:
+                yielded = stack[-1].throw(*exception)
+                exception = None
+            else:
+                yielded = stack[-1].send(value)
+        except (Return, StopIteration), e:
+            stack.pop()
+            value = getattr(e, 'value', None)
+
+            if not stack:
+                return value
+
+            continue
+        except Exception:
+            stack.pop()
+
+            if not stack:
+                raise
+
+            exception = sys.exc_info()
+            continue
+
+        value = None
+
+        if isinstance(yielded, types.GeneratorType):
+            stack.append(yielded)
+        elif isinstance(yielded, sleep_until):
+            if wait:
+                wait(yielded.when)
+            else:
+                delay = yielded.when - time.time()
+                if delay > 0:
+                    time.sleep(delay)
+        elif isinstance(yielded, wait_readable):
+            if isinstance(yielded, wait_writable):
+                ready = select.select([], [yielded.sock], [], yielded.timeout)[1]
+            else:
+                ready = select.select([yielded.sock], [], [], yielded.timeout)[0]
+
+            if not ready:
+                exception = (socket.timeout, socket.timeout('timed out'), None)
+        else:
+            value = yielded
+
+
+class _Task(object):
+    __slots__ = ('stack', 'callback', 'wait')
+
+    def __init__(self, coroutine, callback):
+        self.stack = [coroutine]
+        self.callback = callback
+
+        # Identifies the task's current wait, so that the loser of a race
+        # between an IO event and its timeout can be ignored.
+        self.wait = None
+
+
+class EventLoop(object):
+    """Runs coroutines in a single thread.
+
+    Only one coroutine may wait on a given socket at a time.  Other threads
+    may hand work to the loop with call_soon_threadsafe().
+    """
+
+    def __init__(self, spin=0):
+        self._ready = deque()
+        self._timers = TimerWheel()
+        self._spin = spin
+        self._waiters = {}
+        self._running = False
+
+        if hasattr(select, 'epoll'):
+            self._epoll = select.epoll()
+        else:
+            self._epoll = None
+
+        self._pending = deque()
+        self._pending_lock = Lock()
+        self._wake_read, self._wake_write = os.pipe()
+
+        for fd in (self._wake_read, self._wake_write):
+            flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+            fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+
+        if self._epoll:
+            self._epoll.register(self._wake_read, select.EPOLLIN)
+
+    def spawn(self, coroutine, callback=None):
+        """Start running a coroutine.
+
+        callback, if given, is called with no arguments once the coroutine
+        finishes, whether or not it raised an exception.
+        """
+
+        self._ready.append((_Task(coroutine, callback), None, None))
+
+    def call_soon_threadsafe(self, function, *args):
+        """Arrange for function(*args) to be called in the loop's thread."""
+
+        with self._pending_lock:
+            wake = not self._pending
+            self._pending.append((function, args))
+
+        if wake:
+            try:
+                os.write(self._wake_write, 'x')
+            except OSError, e:
+                if e.errno != errno.EAGAIN:
+                    raise
+
+    def stop(self):
+        """Make run() return once the current iteration completes."""
+
+        self._running = False
+
+    def run(self):
+        self._running = True
+
+        while self._running:
+            self._run_pending()
+
+            while self._ready:
+                self._step(*self._ready.popleft())
+
+            if not self._running:
+                break
+
+            self._poll(self._timeout())
+            self._fire_timers()
+
+    def _run_pending(self):
+        with self._pending_lock:
+            pending = self._pending
+            self._pending = deque()
+
+        for function, args in pending:
+            function(*args)
+
+    def _timeout(self):
+        """Return how long to wait for IO, or None to wait indefinitely."""
+
+        if self._ready or self._pending:
+            return 0
+
+        deadline = self._timers.next_deadline()
+
+        if deadline is None:
+            return None
+        else:
+            return max(0, deadline - self._spin - time.time())
+
+    def _poll(self, timeout):
+        if self._epoll:
+            try:
+                events = self._epoll.poll(-1 if timeout is None else timeout)
+            except IOError, e:
+                if e.errno == errno.EINTR:
+                    return
+                raise
+
+            ready = [fd for fd, event in events]
+        else:
+            readers = [self._wake_read]
+            writers = []
+
+            for fd, (task, wait) in self._waiters.iteritems():
+                if isinstance(wait, wait_writable):
+                    writers.append(fd)
+                else:
+                    readers.append(fd)
+
+            try:
+                readable, writable, _ = select.select(readers, writers, [], timeout)
+            except select.error, e:
+                if e.args[0] == errno.EINTR:
+                    return
+                raise
+
+            ready = readable + writable
+
+        for fd in ready:
+            if fd == self._wake_read:
+                try:
+                    while os.read(self._wake_read, 4096):
+                        pass
+                except OSError, e:
+                    if e.errno != errno.EAGAIN:
+                        raise
+            else:
+                task, wait = self._waiters.pop(fd)
+                self._unregister(fd)
+                task.wait = None
+                self._ready.append((task, None, None))
+
+    def _fire_timers(self):
+        for when, (task, wait) in self._timers.pop(time.time() + self._spin):
+            if task.wait is not wait:
+                # The task has already moved on.
+                continue
+
+            task.wait = None
+
+            # Run the task as soon as it's due, rather than after spinning for
+            # every other timer in this batch.
+            spin_until(when)
+
+            if isinstance(wait, sleep_until):
+                self._step(task, None, None)
+            else:
+                # An IO wait timed out.
+                fd = wait.sock.fileno()
+                del self._waiters[fd]
+                self._unregister(fd)
+                self._ready.append((task, None, (socket.timeout, socket.timeout('timed out'), None)))
+
+    def _unregister(self, fd):
+        if self._epoll:
+            self._epoll.unregister(fd)
+
+    def _wait(self, task, wait):
+        task.wait = wait
+
+        if isinstance(wait, sleep_until):
+            self._timers.add(wait.when, (task, wait))
+            return
+
+        fd = wait.sock.fileno()
+        self._waiters[fd] = (task, wait)
+
+        if self._epoll:
+            if isinstance(wait, wait_writable):
+                self._epoll.register(fd, select.EPOLLOUT)
+            else:
+                self._epoll.register(fd, select.EPOLLIN)
+
+        if wait.timeout is not None:
+            self._timers.add(time.time() + wait.timeout, (task, wait))
+
+    def _step(self, task, value, exception):
+        """Run a task until it waits or finishes."""
+
+        stack = task.stack
+
+        while True:
+            try:
+                if exception:
+                    yielded = stack[-1].throw(*exception)
+                    exception = None
+                else:
+                    yielded = stack[-1].send(value)
+            except (Return, StopIteration), e:
+                stack.pop()
+                value = getattr(e, 'value', None)
+
+                if not stack:
+                    self._finish(task)
+                    return
+
+                continue
+            except Exception:
+                stack.pop()
+                exception = sys.exc_info()
+
+                if not stack:
+                    traceback.print_exception(*exception)
+                    self._finish(task)
+                    return
+
+                continue
+
+            value = None
+
+            if isinstance(yielded, types.GeneratorType):
+                stack.append(yielded)
+            elif isinstance(yielded, sleep_until):
+                if yielded.when > time.time():
+                    self._wait(task, yielded)
+                    return
+            elif isinstance(yielded, wait_readable):
+                self._wait(task, yielded)
+                return
+            else:
+                value = yielded
+
+    def _finish(self, task):
+        if task.callback:
+            task.callback()
+
+
+# Socket helpers.  These are coroutines, for use with sockets in non-blocking
+# mode.
+
+def connect(sock, address, timeout=None):
+    err = sock.connect_ex(address)
+
+    if err in (errno.EINPROGRESS, errno.EWOULDBLOCK):
+        yield wait_writable(sock, timeout)
+        err = sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+
+    if err not in (0, errno.EISCONN):
+        raise socket.error(err, os.strerror(err))
+
+
+def sendall(sock, data, timeout=None):
+    while data:
+        try:
+            sent = sock.send(data)
+            data = data[sent:]
+        except socket.error, e:
+            if e.args[0] not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                raise
+
+            yield wait_writable(sock, timeout)
+
+
+def recv(sock, size, timeout=None):
+    """Receive up to size bytes.  Returns '' once the peer closes."""
+
+    while True:
+        try:
+            raise Return(sock.recv(size))
+        except socket.error, e:
+            if e.args[0] not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                raise
+
+            yield wait_readable(sock, timeout)
@@ -0,0 +1,90 @@
+"""Reducing SQL queries to fingerprints.
+
+A fingerprint is a query with its literals replaced by "?", so that queries
+differing only in their values are counted together:
+
+    SELECT * FROM users WHERE id IN (1, 2, 3) AND name = 'bob'
+
+becomes
+
+    select * from users where id in(?+) and name = ?
+
+Comments are removed, IN lists and multi-row VALUES lists are collapsed,
+whitespace is folded and everything is lowercased.
+
+Fingerprinting a query takes several regex substitutions, so workers look
+fingerprints up in a FingerprintCache.
+"""
+
+import re
+
+
+def _comment_or_string(match):
+    if match.group(1) is not None:
+        return ' '
+
+    return '?'
+
+
+_SUBSTITUTIONS = [(re.compile(pattern, re.IGNORECASE | re.DOTALL), replacement) for pattern, replacement in (
+    # pt-query-digest sometimes adds this to queries.
+    (r'\x00mysql_native_password', ''),
+    # Comments and quoted strings are matched in a single pass, so that
+    # whichever starts first wins: a # or -- inside a string doesn't start a
+    # comment, and a quote inside a comment doesn't start a string.
+    (r'(/\*.*?\*/|(?:--|#)[^\n]*)'
+     r"|'(?:[^'\\]|\\.|'')*'"
+     r'|"(?:[^"\\]|\\.|"")*"', _comment_or_string),
+    (r'\b0x[0-9a-f]+\b', '?'),
+    (r'\b\d+(?:\.\d+)?(?:e[-+]?\d+)?\b', '?'),
+    (r'\s+', ' '),
+    (r'\bin ?\( ?\?(?: ?, ?\?)* ?\)', 'in(?+)'),
+    (r'\b(values ?\([^)]*\))(?: ?, ?\([^)]*\))+', r'\1'),
+    (r' ?; ?$', ''),
+)]
+
+
+def fingerprint(query):
+    """Return the fingerprint of a query."""
+
+    for pattern, replacement in _SUBSTITUTIONS:
+        query = pattern.sub(replacement, query)
+
+    return query.strip().lower()
+
+
+class FingerprintCache(object):
+    """Fingerprints queries, remembering about the size most recently used.
+
+    Moving a query to the end of an OrderedDict on every hit is slow in
+    Python 2, so this keeps two generations of plain dicts instead.  Queries are looked
+    up in the current generation and then the previous one, and are moved
+    into the current one when found.  Once the current generation holds half
+    of size queries, it becomes the previous one, and whatever hasn't been
+    used since is forgotten.
+
+    Safe to share between threads.
+    """
+
+    def __init__(self, size):
+        self._generation_size = max(1, size // 2)
+        self._current = {}
+        self._previous = {}
+
+    def __call__(self, query):
+        result = self._current.get(query)
+
+        if result is not None:
+            return result
+
+        result = self._previous.get(query)
+
+        if result is None:
+            result = fingerprint(query)
+
+        if len(self._current) >= self._generation_size:
+            self._previous, self._current = self._current, {}
+
+        self._current[query] = result
+
+        return result
@@ -0,0 +1,301 @@
+"""Reading and writing jobs index files.
+
+A jobs index lets the QueenBee find each job in a jobs file without unpickling
+the job itself.  It lives next to the jobs file as foo.jobs.index and comes in
+two formats:
+
+    binary - A short header followed by one fixed-width record per job (see
+             INDEX_DTYPE).  The QueenBee memory-maps the file and walks it as
+             a NumPy structured array.
+    pickle - The original format: one protocol-0 pickle of
+             (job_id, start_time, offset) per job.  It is still readable, but
+             unpickling it costs about as much as reading the jobs file itself.
+
+Jobs without any tasks are left out of both formats.
+
+Workers read jobs out of the jobs file through a MappedJobsFile, which
+memory-maps the file once per process.  Decoding a job straight from the map
+needs the job's length, which only the binary index records.
+"""
+
+import cPickle
+import hashlib
+import mmap
+import struct
+from itertools import izip
+from threading import Lock
+
+import numpy
+
+INDEX_MAGIC = 'APIARYIX'
+INDEX_VERSION = 1
+
+# magic, version, record size
+INDEX_HEADER = struct.Struct('<8sII')
+
+INDEX_DTYPE = numpy.dtype([
+    ('job_id', '<u8'),       # see job_key()
+    ('start_time', '<f8'),   # timestamp of the first request
+    ('end_time', '<f8'),     # timestamp of the last request
+    ('offset', '<u8'),       # byte offset of the job's pickle in the jobs file
+    ('length', '<u4'),       # byte length of the job's pickle
+    ('num_tasks', '<u4'),    # number of requests in the job
+])
+
+# Number of records to convert to python objects at a time when walking an
+# index.
+CHUNK_SIZE = 65536
+
+
+def job_key(job_id):
+    """Map a job ID onto the unsigned 64-bit integer stored in the index.
+
+    Non-negative integer IDs are stored as-is.  Anything else (such as the
+    "host:port" IDs produced by genjobs for MySQL) is stored as a hash of its
+    string form.  job_key() is idempotent, so keys read back out of an index
+    can be passed through it again.
+    """
+
+    if isinstance(job_id, (int, long)) and 0 <= job_id < 2 ** 64:
+        return job_id
+
+    return struct.unpack('<Q', hashlib.md5(str(job_id)).digest()[:8])[0]
+
+
+def index_format(path):
+    """Return 'binary' or 'pickle' depending on the format of an index file."""
+
+    with open(path, 'rb') as f:
+        if f.read(len(INDEX_MAGIC)) == INDEX_MAGIC:
+            return 'binary'
+        else:
+            return 'pickle'
+
+
+def open_index(path):
+    """Memory-map a binary index as a read-only NumPy structured array."""
+
+    with open(path, 'rb') as f:
+        header = f.read(INDEX_HEADER.size)
+        f.seek(0, 2)
+        size = f.tell()
+
+    if len(header) < INDEX_HEADER.size:
+        raise ValueError('%s: truncated index header' % path)
+
+    magic, version, record_size = INDEX_HEADER.unpack(header)
+
+    if magic != INDEX_MAGIC:
+        raise ValueError('%s: not a binary jobs index' % path)
+
+    if version != INDEX_VERSION or record_size != INDEX_DTYPE.itemsize:
+        raise ValueError('%s: unsupported index version %d (record size %d)' %
+                         (path, version, record_size))
+
+    count = (size - INDEX_HEADER.size) // record_size
+
+    if count == 0:
+        # numpy refuses to map an empty region.
+        return numpy.zeros(0, dtype=INDEX_DTYPE)
+
+    return numpy.memmap(path, dtype=INDEX_DTYPE, mode='r',
+                        offset=INDEX_HEADER.size, shape=(count,))
+
+
+def iter_index_chunks(index, select=None):
+    """Yield an index a chunk of records at a time.
+
+    select, if given, is called with each chunk and returns the records to
+    yield.
+    """
+
+    for begin in xrange(0, len(index), CHUNK_SIZE):
+        chunk = index[begin:begin + CHUNK_SIZE]
+
+        if select:
+            chunk = select(chunk)
+
+        yield chunk
+
+
+def iter_index(index, select=None):
+    """Yield (job_id, start_time, offset, length) for each record in an index.
+
+    Records are converted to python objects a chunk at a time, which is much
+    faster than indexing the array one record at a time.  select is as for
+    iter_index_chunks().
+    """
+
+    for chunk in iter_index_chunks(index, select):
+        for record in izip(chunk['job_id'].tolist(),
+                           chunk['start_time'].tolist(),
+                           chunk['offset'].tolist(),
+                           chunk['length'].tolist()):
+            yield record
+
+
+def iter_pickle_index(f):
+    """Yield (job_id, start_time, offset) from an open pickle-format index."""
+
+    try:
+        while True:
+            yield cPickle.load(f)
+    except EOFError:
+        pass
+
+
+def iter_jobs(f):
+    """Yield (offset, length, job) for each job in an open jobs file."""
+
+    try:
+        while True:
+            offset = f.tell()
+            job = cPickle.load(f)
+            yield offset, f.tell() - offset, job
+    except EOFError:
+        pass
+
+
+def capture_end(jobs_path):
+    """Return the timestamp of the last request in a jobs file.
+
+    This is quick with a binary index, but otherwise reads the whole jobs
+    file.
+    """
+
+    index_path = jobs_path + '.index'
+
+    try:
+        binary = index_format(index_path) == 'binary'
+    except IOError:
+        binary = False
+
+    if binary:
+        index = open_index(index_path)
+        return float(index['end_time'].max()) if len(index) else 0.0
+
+    end = 0.0
+
+    with open(jobs_path, 'rb') as jobs:
+        for offset, length, (job_id, tasks) in iter_jobs(jobs):
+            if tasks:
+                end = max(end, tasks[-1][0])
+
+    return end
+
+
+class IndexWriter(object):
+    """Writes a binary index, buffering records to keep writes large."""
+
+    BUFFER_RECORDS = 65536
+
+    def __init__(self, path):
+        self._file = open(path, 'wb')
+        self._file.write(INDEX_HEADER.pack(INDEX_MAGIC, INDEX_VERSION,
+                                           INDEX_DTYPE.itemsize))
+        self._buffer = numpy.zeros(self.BUFFER_RECORDS, dtype=INDEX_DTYPE)
+        self._count = 0
+
+    def add(self, job_id, tasks, offset, length):
+        if not tasks:
+            return
+
+        self._buffer[self._count] = (job_key(job_id), tasks[0][0], tasks[-1][0],
+                                     offset, length, len(tasks))
+        self._count += 1
+
+        if self._count == self.BUFFER_RECORDS:
+            self.flush()
+
+    def flush(self):
+        self._file.write(self._buffer[:self._count].tostring())
+        self._count = 0
+
+    def close(self):
+        self.flush()
+        self._file.close()
+
+
+class PickleIndexWriter(object):
+    """Writes an index in the original pickle format."""
+
+    def __init__(self, path):
+        self._file = open(path, 'wb')
+
+    def add(self, job_id, tasks, offset, length):
+        if not tasks:
+            return
+
+        cPickle.dump((job_id, tasks[0][0], offset), self._file)
+
+    def close(self):
+        self._file.close()
+
+
+def write_index(jobs_path, index_path, format='binary'):
+    """Index a jobs file.  Returns the number of jobs indexed."""
+
+    if format == 'binary':
+        writer = IndexWriter(index_path)
+    elif format == 'pickle':
+        writer = PickleIndexWriter(index_path)
+    else:
+        raise ValueError('unknown index format: %s' % format)
+
+    count = 0
+
+    with open(jobs_path, 'rb') as jobs:
+        for offset, length, (job_id, tasks) in iter_jobs(jobs):
+            writer.add(job_id, tasks, offset, length)
+            if tasks:
+                count += 1
+
+    writer.close()
+
+    return count
+
+
+class MappedJobsFile(object):
+    """A jobs file, memory-mapped read-only.
+
+    Any number of threads may read jobs at once, since reading doesn't involve
+    a file position.
+    """
+
+    def __init__(self, path):
+        self._path = path
+
+        with open(path, 'rb') as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def read_job(self, offset, length=0):
+        """Decode the job at offset.  A length of 0 means it isn't known."""
+
+        if length:
+            return cPickle.loads(self._map[offset:offset + length])
+
+        # Without a length, unpickling straight from the file is faster than
+        # feeding the map to cPickle through a python file-like object.
+        with open(self._path, 'rb') as f:
+            f.seek(offset)
+            return cPickle.load(f)
+
+
+_mapped_jobs_files = {}
+_mapped_jobs_files_lock = Lock()
+
+
+def map_jobs_file(path):
+    """Return the MappedJobsFile for path, mapping it on first use.
+
+    Every thread in a process shares the same mapping.
+    """
+
+    try:
+        return _mapped_jobs_files[path]
+    except KeyError:
+        with _mapped_jobs_files_lock:
+            if path not in _mapped_jobs_files:
+                _mapped_jobs_files[path] = MappedJobsFile(path)
+
+            return _mapped_jobs_files[path]
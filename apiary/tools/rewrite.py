@@ -0,0 +1,103 @@
+"""Rewriting the requests of amplified jobs.
+
+With --amplify K, every job runs K times.  Copies other than the first
+usually need their requests changed so that they don't collide with the
+original, for instance on a unique key.  A rewriter is a callable taking
+(request, copy) and returning the request to send, where copy runs from 1 to
+K - 1.  It's built once, before the worker processes start, and called by the
+worker for every request of every copy but the first.
+
+There are two kinds, which can be combined:
+
+    --rewrite REGEX REPLACEMENT
+        Substitute REPLACEMENT for every match of REGEX, as re.sub() does.
+        "{copy}" in REPLACEMENT stands for the copy number.  For example,
+        --rewrite "(user_id = )(\\d+)" "\\g<1>{copy}\\2" gives each copy its
+        own range of user IDs.  Refer to a group just before {copy} as
+        \\g<1> rather than \\1, since "\\1{copy}" becomes "\\11", a
+        reference to group 11.  Rules are checked when the rewriter is built,
+        so a bad one fails at startup rather than in the workers.
+
+    --rewrite-hook MODULE:FUNCTION
+        Call FUNCTION(request, copy), imported from MODULE.
+"""
+
+import re
+import sre_parse
+import importlib
+
+
+class RegexRewriter(object):
+    """Applies a list of (regex, replacement) rules to requests."""
+
+    def __init__(self, rules, copies):
+        # Fill in {copy} ahead of time, so that rewriting a request is only a
+        # matter of calling sub().
+        self._rules = []
+
+        for pattern, replacement in rules:
+            pattern = re.compile(pattern)
+            replacements = [replacement.replace('{copy}', str(copy)) for copy in xrange(copies)]
+
+            for template in replacements:
+                check_template(template, pattern)
+
+            self._rules.append((pattern, replacements))
+
+    def __call__(self, request, copy):
+        for pattern, replacements in self._rules:
+            request = pattern.sub(replacements[copy], request)
+
+        return request
+
+
+def check_template(template, pattern):
+    """Raise re.error if template isn't a valid replacement for pattern.
+
+    re.sub() only checks group references once it finds a match.
+    """
+
+    try:
+        groups, literals = sre_parse.parse_template(template, pattern)
+    except IndexError, e:
+        raise re.error(str(e))
+
+    for index, group in groups:
+        if group > pattern.groups:
+            raise re.error('invalid group reference %d in %r' % (group, template))
+
+
+def load_hook(spec):
+    """Import and return the function named by "module:function"."""
+
+    module_name, _, function_name = spec.partition(':')
+
+    if not module_name or not function_name:
+        raise ValueError('expected MODULE:FUNCTION, got %r' % spec)
+
+    return getattr(importlib.import_module(module_name), function_name)
+
+
+def build_rewriter(rules, hook, copies):
+    """Return a rewriter combining regex rules and a hook, or None if neither."""
+
+    rewriters = []
+
+    if rules:
+        rewriters.append(RegexRewriter(rules, copies))
+
+    if hook:
+        rewriters.append(load_hook(hook))
+
+    if not rewriters:
+        return None
+    elif len(rewriters) == 1:
+        return rewriters[0]
+
+    def rewrite(request, copy):
+        for rewriter in rewriters:
+            request = rewriter(request, copy)
+
+        return request
+
+    return rewrite
@@ -0,0 +1,130 @@
+"""Choosing which jobs to run.
+
+Each job is assigned a number between 0 and 1 by hashing its job ID (via
+job_key()) together with a seed.  Whether a job runs depends only on that
+number and the job's start time, so the same options select the same jobs on
+every run and every host, whatever order jobs arrive in.
+
+Selection happens in three stages, each of which narrows the range of hash
+values that run:
+
+    slice I/N          keep the Ith of N equal parts of the range.  Hosts
+                       given slices 0/N through N-1/N run disjoint sets of
+                       jobs that together cover everything.
+    skip and offset    keep the offset'th of skip + 1 equal parts of what
+                       remains.  With a ramp time, skip decreases by one every
+                       ramp_time seconds of capture time after ramp_start,
+                       down to min_skip.
+    sample rate        keep this fraction of what remains.
+
+Since the parts are ranges of one hash value, a job that runs at a low sample
+rate (or a high skip) also runs at every higher rate (or lower skip).
+"""
+
+from itertools import islice
+
+import numpy
+
+from apiary.tools.jobsindex import job_key
+
+# Number of jobs to hash at a time when selecting from an iterator.
+CHUNK_SIZE = 4096
+
+_GOLDEN_GAMMA = numpy.uint64(0x9E3779B97F4A7C15)
+_MIX1 = numpy.uint64(0xBF58476D1CE4E5B9)
+_MIX2 = numpy.uint64(0x94D049BB133111EB)
+
+
+def _shift(values, bits):
+    # Shifting a uint64 array by a python int promotes it to float64.
+    return values >> numpy.uint64(bits)
+
+
+def job_hash(keys, seed=0):
+    """Map an array of job keys to floats evenly spread over [0, 1).
+
+    Uses the SplitMix64 finalizer, so nearby keys get unrelated values.
+    """
+
+    with numpy.errstate(over='ignore'):
+        z = numpy.asarray(keys, dtype=numpy.uint64) + numpy.uint64(seed) * _GOLDEN_GAMMA
+        z = (z ^ _shift(z, 30)) * _MIX1
+        z = (z ^ _shift(z, 27)) * _MIX2
+        z ^= _shift(z, 31)
+
+    return _shift(z, 11) * 2.0 ** -53
+
+
+class JobSampler(object):
+    """Decides which jobs to run.  See the module docstring."""
+
+    def __init__(self, rate=1.0, seed=0, slice_num=0, num_slices=1, skip=0, offset=0,
+                 min_skip=0, ramp_time=0, ramp_start=0):
+        self._rate = rate
+        self._seed = seed
+        self._slice = slice_num
+        self._num_slices = num_slices
+        self._skip = skip
+        self._offset = offset
+        self._min_skip = min_skip
+        self._ramp_time = ramp_time
+        self._ramp_start = ramp_start
+
+    @property
+    def selects_all(self):
+        return self._rate >= 1 and self._num_slices == 1 and not self._skip
+
+    def mask(self, keys, start_times):
+        """Return a boolean array that's True for each job that should run.
+
+        keys are the jobs' job_key()s, and start_times the capture times of
+        their first requests.
+        """
+
+        position = job_hash(keys, self._seed) * self._num_slices - self._slice
+
+        if self._ramp_time:
+            skip = numpy.maximum(self._min_skip,
+                                 self._skip - numpy.floor(numpy.subtract(start_times, self._ramp_start))
+                                 // self._ramp_time)
+        else:
+            skip = self._skip
+
+        # Once the ramp brings skip down to 0, every job runs, whatever the
+        # offset.
+        position = position * (skip + 1) - numpy.where(skip, self._offset, 0)
+
+        return (position >= 0) & (position < self._rate)
+
+    def filter_index(self, chunk):
+        """Return the records in a chunk of a binary index that should run."""
+
+        if self.selects_all:
+            return chunk
+
+        return chunk[self.mask(chunk['job_id'], chunk['start_time'])]
+
+    def filter_jobs(self, jobs):
+        """Yield the jobs that should run.
+
+        jobs is an iterator of tuples that begin with (job_id, start_time).
+        """
+
+        if self.selects_all:
+            for job in jobs:
+                yield job
+
+            return
+
+        while True:
+            chunk = list(islice(jobs, CHUNK_SIZE))
+
+            if not chunk:
+                break
+
+            keys = [job_key(job[0]) for job in chunk]
+            start_times = [job[1] for job in chunk]
+
+            for job, selected in zip(chunk, self.mask(keys, start_times)):
+                if selected:
+                    yield job
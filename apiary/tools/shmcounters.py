@@ -0,0 +1,135 @@
+"""Shared-memory counters for tallies.
+
+Tallies such as Requests Completed are counted for every request.  Rather than
+sending them to the StatsGatherer, each writer (a WorkerBee thread, or a
+worker process's event loop with --engine async) adds to its own row of
+counters in shared memory, and the StatsGatherer sums the rows when it
+reports.  Each row has a single writer, so no locks are needed.  Counters only
+go up, so a sum read while writers are busy is at worst a moment out of date.
+
+Slots are numbered separately in each worker process.  A process assigns a
+slot to each tally the first time it's counted, and tells the StatsGatherer
+the new slot's name with its next stats snapshot.  Once a process's slots are
+used up, further tallies have to be counted some other way.
+
+As with ShmRings, the memory must be allocated before the worker and
+StatsGatherer processes fork.
+"""
+
+import ctypes
+from threading import Lock
+from multiprocessing import RawArray
+
+import numpy
+
+
+class ShmCounters(object):
+    """Counters for num_processes processes of num_writers rows each."""
+
+    def __init__(self, num_processes, num_writers, num_slots):
+        self.num_processes = num_processes
+        self.num_writers = num_writers
+        self.num_slots = num_slots
+
+        self._memory = RawArray(ctypes.c_uint64, num_processes * num_writers * num_slots)
+        self._counts = numpy.frombuffer(self._memory, dtype=numpy.uint64).reshape(
+            num_processes, num_writers, num_slots)
+
+    def registry(self, process):
+        """Return a process's SlotRegistry.  Call in that process."""
+
+        return SlotRegistry(self, process)
+
+    def row(self, process, writer):
+        """Return a writer's row as a ctypes array, which is quicker to add to
+        one counter at a time than a NumPy array."""
+
+        row_size = self.num_slots * ctypes.sizeof(ctypes.c_uint64)
+        offset = (process * self.num_writers + writer) * row_size
+
+        return (ctypes.c_uint64 * self.num_slots).from_buffer(self._memory, offset)
+
+    def totals(self):
+        """Return an array of each process's count in each slot."""
+
+        return self._counts.sum(axis=1)
+
+
+class SlotRegistry(object):
+    """Assigns one process's slots to names, and hands out its writers' rows."""
+
+    def __init__(self, counters, process):
+        self._counters = counters
+        self._process = process
+        self._lock = Lock()
+        self._free_rows = range(counters.num_writers)
+        self._new_names = {}
+
+        # Read without the lock by CounterRow.add().
+        self.slots = {}
+
+    def register(self, name):
+        """Return the slot for name, assigning one if need be.
+
+        Returns None if every slot is taken.
+        """
+
+        with self._lock:
+            slot = self.slots.get(name)
+
+            if slot is None and len(self.slots) < self._counters.num_slots:
+                slot = len(self.slots)
+                self._new_names[slot] = name
+                self.slots[name] = slot
+
+            return slot
+
+    def new_names(self):
+        """Return {slot: name} for slots assigned since the last call."""
+
+        with self._lock:
+            names, self._new_names = self._new_names, {}
+
+        return names
+
+    def take_row(self):
+        """Return a CounterRow for a new writer, or None if there are none left."""
+
+        with self._lock:
+            if not self._free_rows:
+                return None
+
+            writer = self._free_rows.pop(0)
+
+        return CounterRow(self, writer, self._counters.row(self._process, writer))
+
+    def release_row(self, row):
+        """Return a writer's row once it's done counting, for reuse."""
+
+        with self._lock:
+            self._free_rows.append(row.writer)
+
+
+class CounterRow(object):
+    """One writer's counters.  Only one thread may add to a row."""
+
+    def __init__(self, registry, writer, counts):
+        self.writer = writer
+        self._registry = registry
+        self._slots = registry.slots
+        self._counts = counts
+
+    def add(self, name, count=1):
+        """Count name, returning False if there's no slot for it."""
+
+        slot = self._slots.get(name)
+
+        if slot is None:
+            slot = self._registry.register(name)
+
+            if slot is None:
+                return False
+
+        self._counts[slot] += count
+
+        return True
@@ -0,0 +1,132 @@
+"""Shared-memory ring buffers for sending jobs from QueenBees to workers.
+
+ShmRings is an alternative to multiprocessing.Queue for the job queue
+(--transport shm).  Each worker process gets a ring of fixed-size slots in
+shared memory, written only by its QueenBee and read only by the worker's
+feeder thread.  Neither side takes a lock, makes a system call or pickles
+anything to pass a job; the producer writes slots and then advances the ring's
+head counter, and the consumer reads slots and then advances its tail counter.
+
+This relies on each side's stores becoming visible to the other in program
+order, which holds on x86.  The memory must be allocated before the worker and
+QueenBee processes fork.
+
+A side that finds its ring empty (consumer) or full (producer) polls with
+an increasing sleep between attempts.
+"""
+
+import time
+import ctypes
+from multiprocessing import RawArray
+from multiprocessing.queues import Empty
+
+import numpy
+
+SLOT_DTYPE = numpy.dtype([
+    ('type', '<u2'),
+    ('copy', '<u2'),
+    ('length', '<u4'),
+    ('start_time', '<f8'),
+    ('job_id', '<u8'),
+    ('offset', '<u8'),
+    ('loop', '<u8'),
+])
+
+# Counters are spaced out so that each ring's head and tail sit on cache lines
+# of their own.
+COUNTER_STRIDE = 8
+
+# Bounds for the sleep between polls of an empty or full ring, in seconds.
+MIN_POLL_INTERVAL = 0.00001
+MAX_POLL_INTERVAL = 0.001
+
+
+def _backoff(interval):
+    """Sleep for interval, then return the interval for the next poll."""
+
+    time.sleep(interval)
+
+    return min(interval * 2, MAX_POLL_INTERVAL)
+
+
+class ShmRings(object):
+    """A set of single-producer, single-consumer rings of job slots.
+
+    Slots hold (type, copy, length, start_time, job_id, offset, loop) records;
+    see SLOT_DTYPE.
+    """
+
+    def __init__(self, num_rings, capacity):
+        self.num_rings = num_rings
+        self.capacity = capacity
+
+        self._slots_memory = RawArray(ctypes.c_char, num_rings * capacity * SLOT_DTYPE.itemsize)
+        self._counters_memory = RawArray(ctypes.c_uint64, num_rings * 2 * COUNTER_STRIDE)
+
+        self._slots = numpy.frombuffer(self._slots_memory, dtype=SLOT_DTYPE).reshape(num_rings, capacity)
+
+        counters = numpy.frombuffer(self._counters_memory, dtype=numpy.uint64)
+        counters = counters.reshape(num_rings, 2, COUNTER_STRIDE)
+        self._heads = counters[:, 0, 0]
+        self._tails = counters[:, 1, 0]
+
+    def occupancy(self, rings):
+        """Return the number of unread slots in each of the given rings."""
+
+        return self._heads[rings] - self._tails[rings]
+
+    def least_loaded(self, rings):
+        """Return whichever of the given rings has the fewest unread slots."""
+
+        return rings[numpy.argmin(self.occupancy(rings))]
+
+    def put(self, ring, records):
+        """Append records to a ring, waiting for space if it's full."""
+
+        capacity = self.capacity
+        slots = self._slots[ring]
+
+        while records:
+            head = int(self._heads[ring])
+            free = capacity - (head - int(self._tails[ring]))
+            interval = MIN_POLL_INTERVAL
+
+            while not free:
+                interval = _backoff(interval)
+                free = capacity - (head - int(self._tails[ring]))
+
+            chunk, records = records[:free], records[free:]
+            start = head % capacity
+
+            if len(chunk) == 1:
+                slots[start] = chunk[0]
+            else:
+                chunk = numpy.array(chunk, dtype=SLOT_DTYPE)
+                before_wrap = min(len(chunk), capacity - start)
+                slots[start:start + before_wrap] = chunk[:before_wrap]
+                slots[:len(chunk) - before_wrap] = chunk[before_wrap:]
+
+            # Publish the new slots only once they're written.
+            self._heads[ring] = head + len(chunk)
+
+    def get(self, ring, block=True):
+        """Remove and return the oldest record in a ring as a tuple.
+
+        If block is False and the ring is empty, raises Queue.Empty.
+        """
+
+        tail = int(self._tails[ring])
+        interval = MIN_POLL_INTERVAL
+
+        while int(self._heads[ring]) == tail:
+            if not block:
+                raise Empty
+
+            interval = _backoff(interval)
+
+        record = self._slots[ring, tail % self.capacity].item()
+
+        # Release the slot only once it's read.
+        self._tails[ring] = tail + 1
+
+        return record
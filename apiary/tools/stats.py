@@ -6,7 +6,16 @@ Periodically, apairy calls report() to retrieve information from the statistic.
 
 Statistics should aggregate information between calls to report().  They should
 also produce information about the change in each value since the last call
-to report().
+to report().  They can also summarize() everything they've seen up to the last
+report(), for the per-phase summary at the end of a run.
+
+Worker processes collect their own stats and send them on as snapshots, which
+the StatsGatherer merges: Tally.add() takes a count, a Level merges each
+source's share of the level, and a Series merges Histograms.
+
+A Breakdown splits a series by key, such as MySQL query fingerprint.  It isn't
+part of the periodic reports; the StatsGatherer prints a table of its busiest
+keys at the end of the run.
 
 Types of stats:
 
@@ -14,17 +23,32 @@ Types of stats:
             number of events in each interval, and the total number of
             events.
     level  - Tracks a quantity that increments and decrements.  Reports the
-            current level and the high/low/median/mean during the interval.
-    series - Tracks a value as it changes over time.  Reports the mean/median/
-            min/max/stdev in the interval.
+            current level and the high/low during the interval, and the
+            median/mean/stdev weighted by how long each level lasted.
+    series - Tracks a value as it changes over time.  Reports the mean and
+            max in the interval, and percentiles estimated from a Histogram.
 """
 
 import numpy
 import math
 import time
-from collections import OrderedDict
+from collections import OrderedDict, defaultdict
 from .table import ALIGN_LEFT, ALIGN_CENTER, ALIGN_RIGHT
 
+# Histograms estimate percentiles to within this fraction of the true value.
+DEFAULT_RELATIVE_ERROR = 0.01
+
+# Histograms count values closer to zero than this as zero.
+MIN_HISTOGRAM_VALUE = 1e-9
+
+# Histograms bucket values this many at a time.
+HISTOGRAM_BATCH_SIZE = 4096
+
+PERCENTILES = (50, 90, 99, 99.9)
+
+# The most keys a Breakdown keeps, by default.
+BREAKDOWN_KEYS = 1000
+
 
 class Statistic(object):
     def __init__(self):
@@ -46,6 +70,14 @@ class Statistic(object):
         """Clear all stored values."""
         raise NotImplementedError()
 
+    def summarize(self):
+        """Return a dict of aggregate stats over the statistic's whole life.
+
+        Covers the values seen up to the last reset().  Statistics that have
+        no meaningful summary return an empty dict.
+        """
+        return OrderedDict()
+
     def format_number(self, value):
         raise NotImplementedError()
 
@@ -106,14 +138,20 @@ class FloatStatistic(Statistic):
 
 
 class Tally(IntegerStatistic):
-    def __init__(self):
+    def __init__(self, start_time=None):
         super(IntegerStatistic,self).__init__()
 
         self._grand_total = 0
         self.reset()
 
-    def add(self):
-        self._total += 1
+        # Counts added later may have been counted since start_time.
+        if start_time is not None:
+            self._start_time = start_time
+
+        self._created = self._start_time
+
+    def add(self, count=1):
+        self._total += count
 
     def calculate(self):
         self._grand_total += self._total
@@ -130,62 +168,437 @@ class Tally(IntegerStatistic):
         self._total = 0
         self._start_time = time.time()
 
+    def summarize(self):
+        stats = OrderedDict()
+
+        stats["Total"] = self._grand_total
+        elapsed = self._start_time - self._created
+        stats["Rate"] = self._grand_total / elapsed if elapsed > 0 else 0
+
+        return stats
+
 class Level(IntegerStatistic):
-    def __init__(self):
+    """A Level weights its stats by time, in constant memory.
+
+    Rather than every level it passes through, a Level keeps the number of
+    seconds spent at each level.  Its mean is then the average level over
+    time, such as the average number of requests in flight.
+
+    A Level can instead be built from snapshots of its sources' shares of it
+    (see merge()).  It then keeps no time itself.
+    """
+
+    def __init__(self, level=0):
         super(Level,self).__init__()
 
-        self._level = 0
-        self._levels = [0]
+        self._level = level
+        self._last_change = time.time()
+
+        # Seconds spent at each level in previous intervals.
+        self._history = defaultdict(float)
+        self._lowest = self._highest = level
+
+        # Seconds spent at each level this interval.
+        self._seconds = defaultdict(float)
+        self._min = self._max = level
+
+        # Each source's share of the level, once snapshots are merged.
+        self._shares = {}
+
+    @property
+    def current(self):
+        return self._level
+
+    def _account(self):
+        now = time.time()
+
+        if not self._shares:
+            self._seconds[self._level] += now - self._last_change
+
+        self._last_change = now
 
     def add(self, direction):
+        self._account()
+
         if direction == "+":
             self._level += 1
+
+            if self._level > self._max:
+                self._max = self._level
         elif direction == "-":
             self._level -= 1
 
-        self._levels.append(self._level)
+            if self._level < self._min:
+                self._min = self._level
 
     def reset(self):
-        self._levels = []
+        for level, seconds in self._seconds.iteritems():
+            self._history[level] += seconds
+
+        self._lowest = min(self._lowest, self._min)
+        self._highest = max(self._highest, self._max)
+        self._seconds = defaultdict(float)
+        self._min = self._max = self._level
+
+    def snapshot(self):
+        """Return (level, {level: seconds}) and start counting time afresh."""
+
+        self._account()
+        seconds, self._seconds = self._seconds, defaultdict(float)
+
+        return self._level, dict(seconds)
+
+    def merge(self, source, level, seconds):
+        """Merge a snapshot of one source's share of the level.
+
+        seconds is what source's own Level.snapshot() returned: the time it
+        spent at each of its levels since its last snapshot.  That time counts
+        as time spent at the source's level plus every other source's latest
+        share, as if the other sources had held steady since their own last
+        snapshots.  With one source that's exact.  With several, it's only
+        approximate: sources snapshot at different moments, and a snapshot
+        that spans a report is counted entirely in the report it arrives in,
+        so every statistic, the mean included, can be off by about the level
+        changes within one snapshot interval.
+        """
+
+        others = self._level - self._shares.get(source, 0)
+
+        for share, elapsed in seconds.iteritems():
+            self._seconds[others + share] += elapsed
+            self._min = min(self._min, others + share)
+            self._max = max(self._max, others + share)
+
+        self._shares[source] = level
+        self._level = others + level
+        self._min = min(self._min, self._level)
+        self._max = max(self._max, self._level)
+
+    def carry_over(self):
+        """Return a new Level that starts at this one's current level."""
+
+        level = Level(self._level)
+        level._shares = dict(self._shares)
+
+        return level
 
     def calculate(self):
+        self._account()
+
         stats = OrderedDict()
 
         stats['Current'] = self._level
+        stats['Min'] = self._min
+        stats['Max'] = self._max
 
-        if self._levels:
-            add_series_stats(stats, self._levels)
+        if self._seconds:
+            add_level_stats(stats, self._seconds)
 
         return stats
 
+    def summarize(self):
+        stats = OrderedDict()
+
+        if self._history:
+            stats['Min'] = self._lowest
+            stats['Max'] = self._highest
+            add_level_stats(stats, self._history)
+
+        return stats
+
+    def format_number(self, value):
+        if isinstance(value, float):
+            return "%.2f" % value
+        else:
+            return "%d" % value
+
+    def format_change(self, value):
+        if not value:
+            return ""
+        elif isinstance(value, float):
+            return "(%+.2f)" % value
+        else:
+            return "(%+d)" % value
+
+
+class Histogram(object):
+    """Counts values in buckets whose bounds grow geometrically.
+
+    Every value in a bucket is within relative_error of the bucket's midpoint,
+    so percentiles come out within relative_error of a value that was added.
+    Memory grows with the log of the range of values rather than with their
+    number.  Negative values get buckets of their own.  Histograms with the
+    same relative_error can be merged.
+
+    add() only appends to a list.  Values are bucketed with NumPy once
+    HISTOGRAM_BATCH_SIZE of them have built up, or when the histogram is read.
+    """
+
+    def __init__(self, relative_error=DEFAULT_RELATIVE_ERROR):
+        self.relative_error = relative_error
+        self._gamma = (1 + relative_error) / (1 - relative_error)
+        self._log_gamma = math.log(self._gamma)
+
+        self._positive = defaultdict(int)
+        self._negative = defaultdict(int)
+        self._zeros = 0
+        self._pending = []
+
+        self._count = 0
+        self._total = 0.0
+        self._min = None
+        self._max = None
+        self._last = None
+
+    def __getstate__(self):
+        # Send buckets rather than raw values between processes.
+        self._flush()
+
+        return self.__dict__
+
+    def add(self, value):
+        pending = self._pending
+        pending.append(value)
+
+        if len(pending) >= HISTOGRAM_BATCH_SIZE:
+            self._flush()
+
+    def _flush(self):
+        if not self._pending:
+            return
+
+        values = numpy.array(self._pending, dtype=numpy.float64)
+        self._last = self._pending[-1]
+        self._pending = []
+
+        self._count += len(values)
+        self._total += values.sum()
+
+        low = values.min()
+        high = values.max()
+        self._min = low if self._min is None else min(self._min, low)
+        self._max = high if self._max is None else max(self._max, high)
+
+        positive = values[values > MIN_HISTOGRAM_VALUE]
+        negative = -values[values < -MIN_HISTOGRAM_VALUE]
+        self._zeros += len(values) - len(positive) - len(negative)
+
+        for buckets, magnitudes in ((self._positive, positive), (self._negative, negative)):
+            if len(magnitudes):
+                indexes = numpy.ceil(numpy.log(magnitudes) / self._log_gamma).astype(numpy.int64)
+                lowest = indexes.min()
+                counts = numpy.bincount(indexes - lowest)
+                used = numpy.flatnonzero(counts)
+
+                for index, count in zip((used + lowest).tolist(), counts[used].tolist()):
+                    buckets[index] += count
+
+    @property
+    def count(self):
+        return self._count + len(self._pending)
+
+    @property
+    def last(self):
+        """The value most recently added."""
+
+        return self._pending[-1] if self._pending else self._last
+
+    @property
+    def total(self):
+        self._flush()
+        return self._total
+
+    @property
+    def min(self):
+        self._flush()
+        return self._min
+
+    @property
+    def max(self):
+        self._flush()
+        return self._max
+
+    def merge(self, other):
+        """Add the counts from another Histogram to this one."""
+
+        if other.relative_error != self.relative_error:
+            raise ValueError("can't merge histograms with different relative errors")
+
+        other._flush()
+        self._flush()
+
+        for index, count in other._positive.iteritems():
+            self._positive[index] += count
+
+        for index, count in other._negative.iteritems():
+            self._negative[index] += count
+
+        self._zeros += other._zeros
+        self._count += other._count
+        self._total += other._total
+
+        if other._count:
+            self._min = other._min if self._min is None else min(self._min, other._min)
+            self._max = other._max if self._max is None else max(self._max, other._max)
+            self._last = other._last
+
+    @property
+    def mean(self):
+        return self.total / self.count if self.count else None
+
+    def percentiles(self, percentiles=PERCENTILES):
+        """Return estimates of the given percentiles (in ascending order)."""
+
+        self._flush()
+
+        if not self._count:
+            return [None] * len(percentiles)
+
+        # Walk the buckets from the most negative value to the most positive.
+        buckets = ([(-self._midpoint(index), self._negative[index])
+                    for index in sorted(self._negative, reverse=True)] +
+                   [(0.0, self._zeros)] +
+                   [(self._midpoint(index), self._positive[index])
+                    for index in sorted(self._positive)])
+
+        # Nearest-rank percentiles: the value with rank ceil(count * p / 100).
+        results = []
+        ranks = iter([max(1, int(math.ceil(self._count * percentile / 100.0))) for percentile in percentiles])
+        rank = next(ranks)
+        seen = 0
+
+        for value, count in buckets:
+            seen += count
+
+            while rank is not None and rank <= seen:
+                results.append(min(max(value, self._min), self._max))
+                rank = next(ranks, None)
+
+            if rank is None:
+                break
+
+        return results
+
+    def _midpoint(self, index):
+        # Bucket index covers (gamma ** (index - 1), gamma ** index].
+        return 2 * self._gamma ** index / (self._gamma + 1)
+
 
 class Series(FloatStatistic):
-    def __init__(self):
+    def __init__(self, relative_error=DEFAULT_RELATIVE_ERROR):
         super(Series, self).__init__()
 
-        self._values = []
+        self._relative_error = relative_error
 
-    def add(self, value):
-        self._values.append(value)
+        # Everything from previous intervals.
+        self._history = Histogram(relative_error)
+
+        self._start_interval()
+
+    def _start_interval(self):
+        self._interval = Histogram(self._relative_error)
+
+        # The StatsGatherer adds a value for every request, so skip a level
+        # of method call.
+        self.add = self._interval.add
+
+    def merge(self, histogram):
+        """Add a Histogram of values, such as one collected elsewhere."""
+
+        self._interval.merge(histogram)
 
     def reset(self):
-        self._values = []
+        self._history.merge(self._interval)
+        self._start_interval()
 
     def calculate(self):
         stats = OrderedDict()
 
-        if self._values:
-            stats['Current'] = self._values[-1]
-            add_series_stats(stats, self._values)
+        if self._interval.count:
+            stats['Current'] = self._interval.last
+            add_histogram_stats(stats, self._interval)
+
+        return stats
+
+    def summarize(self):
+        stats = OrderedDict()
+
+        if self._history.count:
+            stats['Count'] = self._history.count
+            add_histogram_stats(stats, self._history)
 
         return stats
 
 
-def add_series_stats(stats, series):
-    series = numpy.array(series)
+class Breakdown(object):
+    """Histograms of a series' values, by key, for the keys with the largest totals.
+
+    Once there are twice max_keys keys, all but the max_keys with the
+    largest totals are dropped, so memory stays bounded however many keys
+    there are.  A key that's dropped and comes back starts again from zero.
+    """
+
+    def __init__(self, relative_error=DEFAULT_RELATIVE_ERROR, max_keys=BREAKDOWN_KEYS):
+        self._relative_error = relative_error
+        self._max_keys = max_keys
+        self._histograms = {}
+
+    def __len__(self):
+        return len(self._histograms)
+
+    def _histogram(self, key):
+        histogram = self._histograms.get(key)
+
+        if histogram is None:
+            if len(self._histograms) >= 2 * self._max_keys:
+                self._prune()
+
+            histogram = self._histograms[key] = Histogram(self._relative_error)
+
+        return histogram
+
+    def _prune(self):
+        self._histograms = dict(self.top(self._max_keys))
+
+    def add(self, key, value):
+        self._histogram(key).add(value)
+
+    def merge(self, histograms):
+        """Merge a dict of Histograms by key, such as a worker collected."""
+
+        for key, histogram in histograms.iteritems():
+            self._histogram(key).merge(histogram)
+
+    def top(self, n):
+        """Return [(key, Histogram)] for the n keys with the largest totals."""
+
+        ranked = sorted(self._histograms.iteritems(), key=lambda item: item[1].total, reverse=True)
+
+        return ranked[:n]
+
+
+def add_histogram_stats(stats, histogram):
+    stats['Mean'] = histogram.mean
+
+    for percentile, value in zip(PERCENTILES, histogram.percentiles()):
+        stats['p%s' % percentile] = value
+
+    stats['Max'] = histogram.max
+
+
+def add_level_stats(stats, seconds):
+    """Add the median, mean and stdev of levels weighted by seconds at each."""
+
+    levels = numpy.array(sorted(seconds), dtype=numpy.float64)
+    weights = numpy.array([seconds[level] for level in sorted(seconds)])
+    total = weights.sum()
+
+    if total <= 0:
+        weights = numpy.ones(len(levels))
+        total = len(levels)
+
+    mean = numpy.dot(levels, weights) / total
 
-    stats['Min'] = numpy.min(series)
-    stats['Max'] = numpy.max(series)
-    stats['Median'] = numpy.median(series)
-    stats['Mean'] = numpy.mean(series)
-    stats['Stdev'] = numpy.std(series)
+    stats['Median'] = int(levels[numpy.searchsorted(numpy.cumsum(weights), total / 2.0)])
+    stats['Mean'] = float(mean)
+    stats['Stdev'] = float(numpy.sqrt(numpy.dot(weights, (levels - mean) ** 2) / total))
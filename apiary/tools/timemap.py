@@ -0,0 +1,160 @@
+"""Mapping between capture time and replay time.
+
+Job timestamps are seconds since the start of the capture.  A TimeMap says how
+many seconds after the start of the run each timestamp should be replayed.
+With --speedup alone, that's simply timestamp / speedup.  If the run starts
+partway through the capture (--start-at), timestamps are first made relative
+to that point, the origin.  A load profile
+(--load-profile) instead varies the speedup over the course of the run.
+
+A load profile is a text file with one segment per line:
+
+    # duration   speedup
+    10m          1            # 1x for 10 minutes
+    5m           ramp 4       # speed up steadily to 4x over 5 minutes
+    20m          4            # hold at 4x
+    30s          10           # spike to 10x for 30 seconds
+    1h           1
+
+Durations are in run time, as a number with an optional s, m or h suffix
+(seconds if there's none).  A "ramp" segment changes the speedup linearly from
+the end of the previous segment (or 1x) to the given value.  After the last
+segment, the run continues at that segment's final speedup.
+"""
+
+import math
+from bisect import bisect_right
+
+DURATION_UNITS = {'s': 1, 'm': 60, 'h': 3600}
+
+
+class TimeMap(object):
+    """A piecewise-linear speedup, as a function of time into the run.
+
+    segments is a list of (duration, start_speedup, end_speedup).  speedup
+    applies after the last segment (by default, the last segment's final
+    speedup), or throughout if there are none.  origin is the capture time at
+    which the run starts.
+    """
+
+    def __init__(self, segments=(), speedup=None, origin=0.0):
+        self.origin = origin
+
+        if speedup is None:
+            speedup = segments[-1][2] if segments else 1.0
+
+        self.speedup = speedup
+
+        # Run time and capture time at the start of each segment, and the
+        # segments themselves as (start_speedup, acceleration).
+        self._run_starts = []
+        self._capture_starts = []
+        self._segments = []
+
+        run_time = capture_time = 0.0
+
+        for duration, start_speedup, end_speedup in segments:
+            if start_speedup <= 0 or end_speedup <= 0:
+                raise ValueError('speedup must be positive')
+
+            acceleration = (end_speedup - start_speedup) / float(duration)
+
+            self._run_starts.append(run_time)
+            self._capture_starts.append(capture_time)
+            self._segments.append((start_speedup, acceleration))
+
+            run_time += duration
+            capture_time += duration * (start_speedup + end_speedup) / 2.0
+
+        self._run_end = run_time
+        self._capture_end = capture_time
+
+    def run_time(self, capture_time):
+        """Return the time into the run at which to replay capture_time."""
+
+        capture_time -= self.origin
+
+        if capture_time >= self._capture_end or not self._segments:
+            return self._run_end + (capture_time - self._capture_end) / self.speedup
+
+        segment = bisect_right(self._capture_starts, capture_time) - 1
+
+        if segment < 0:
+            return capture_time / self._segments[0][0]
+
+        speedup, acceleration = self._segments[segment]
+        captured = capture_time - self._capture_starts[segment]
+
+        # Solve captured = speedup * t + acceleration * t^2 / 2 for t, in a
+        # form that's stable when acceleration is small or zero.
+        elapsed = 2 * captured / (speedup + math.sqrt(speedup ** 2 + 2 * acceleration * captured))
+
+        return self._run_starts[segment] + elapsed
+
+    def capture_time(self, run_time):
+        """Return the capture time replayed at run_time.  The inverse of run_time()."""
+
+        if run_time >= self._run_end or not self._segments:
+            return self.origin + self._capture_end + (run_time - self._run_end) * self.speedup
+
+        segment = bisect_right(self._run_starts, run_time) - 1
+
+        if segment < 0:
+            return self.origin + run_time * self._segments[0][0]
+
+        speedup, acceleration = self._segments[segment]
+        elapsed = run_time - self._run_starts[segment]
+
+        return (self.origin + self._capture_starts[segment] +
+                speedup * elapsed + acceleration * elapsed ** 2 / 2)
+
+
+def parse_duration(text):
+    if text[-1] in DURATION_UNITS:
+        return float(text[:-1]) * DURATION_UNITS[text[-1]]
+    else:
+        return float(text)
+
+
+def read_profile(path):
+    """Read a load profile file and return its segments, for a TimeMap.
+
+    Raises ValueError (mentioning the line number) if the file is invalid.
+    """
+
+    segments = []
+    speedup = 1.0
+
+    with open(path) as profile:
+        for line_num, line in enumerate(profile, 1):
+            fields = line.split('#', 1)[0].split()
+
+            if not fields:
+                continue
+
+            try:
+                if len(fields) == 2:
+                    duration = parse_duration(fields[0])
+                    start_speedup = end_speedup = float(fields[1])
+                elif len(fields) == 3 and fields[1] == 'ramp':
+                    duration = parse_duration(fields[0])
+                    start_speedup = speedup
+                    end_speedup = float(fields[2])
+                else:
+                    raise ValueError('expected "DURATION SPEEDUP" or "DURATION ramp SPEEDUP"')
+
+                if duration <= 0:
+                    raise ValueError('duration must be positive')
+
+                if end_speedup <= 0:
+                    raise ValueError('speedup must be positive')
+            except ValueError, e:
+                raise ValueError('%s, line %d: %s' % (path, line_num, e))
+
+            segments.append((duration, start_speedup, end_speedup))
+            speedup = end_speedup
+
+    if not segments:
+        raise ValueError('%s: no segments' % path)
+
+    return segments
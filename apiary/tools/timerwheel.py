@@ -0,0 +1,252 @@
+"""Accurate timers for pacing requests.
+
+Sleeping until a request is due with time.sleep() tends to wake late: the OS
+oversleeps, and a thread that wakes must then wait its turn for the GIL.  At
+high --speedup, the gaps between requests can be smaller than that error.
+
+A worker process instead keeps the fire time of every pending request in one
+TimerWheel.  A single thread (Scheduler) or the process's EventLoop sleeps
+until shortly before the next timer is due and then busy-waits for the last
+--spin-time microseconds, so the request fires on time.
+
+The wheel is hierarchical: LEVELS wheels of SLOTS slots each, where a slot in
+level n covers SLOTS ** n ticks.  Adding a timer is constant time, and timers
+cascade down to finer levels as their time approaches.  Timers in the current
+tick are kept in a heap so that they can be fired in exact order.
+"""
+
+import os
+import errno
+import fcntl
+import heapq
+import select
+import time
+from itertools import count
+from threading import Thread, Lock
+
+SLOT_BITS = 8
+SLOTS = 1 << SLOT_BITS
+SLOT_MASK = SLOTS - 1
+LEVELS = 4
+
+# Length of a tick in seconds.
+DEFAULT_RESOLUTION = 0.001
+
+
+def spin_until(when):
+    """Busy-wait until time.time() >= when."""
+
+    while time.time() < when:
+        pass
+
+
+class TimerWheel(object):
+    """A hierarchical timer wheel.  Not thread-safe."""
+
+    def __init__(self, resolution=DEFAULT_RESOLUTION):
+        self._resolution = resolution
+        self._wheels = [[[] for slot in xrange(SLOTS)] for level in xrange(LEVELS)]
+        self._overflow = []
+        self._current = int(time.time() / resolution)
+        self._count = 0
+        self._due = []
+        self._sequence = count()
+
+    def __len__(self):
+        return self._count + len(self._due)
+
+    def add(self, when, item):
+        """Schedule item to be returned by pop() at time when."""
+
+        self._place((when, next(self._sequence), item))
+
+    def next_deadline(self):
+        """Return the time the next timer is due, or None if there are none.
+
+        If the next timer hasn't yet cascaded down to the current tick, this
+        returns the start of its tick (or of the next cascade), which is
+        earlier than the timer itself.
+        """
+
+        if self._due:
+            return self._due[0][0]
+
+        if not self._count:
+            return None
+
+        return self._next_tick() * self._resolution
+
+    def pop(self, now):
+        """Remove and return (when, item) for each timer due by now, in order."""
+
+        self._advance(int(now / self._resolution))
+
+        due = self._due
+        popped = []
+
+        while due and due[0][0] <= now:
+            when, sequence, item = heapq.heappop(due)
+            popped.append((when, item))
+
+        return popped
+
+    def _place(self, entry):
+        tick = int(entry[0] / self._resolution)
+        current = self._current
+
+        if tick <= current:
+            heapq.heappush(self._due, entry)
+            return
+
+        self._count += 1
+
+        for level in xrange(LEVELS):
+            shift = SLOT_BITS * (level + 1)
+
+            if tick >> shift == current >> shift:
+                self._wheels[level][(tick >> (SLOT_BITS * level)) & SLOT_MASK].append(entry)
+                return
+
+        self._overflow.append(entry)
+
+    def _next_tick(self):
+        """Return the first tick after the current one that holds timers.
+
+        A slot in a coarser level counts as holding timers from the tick it
+        begins at, since that's when it cascades.
+        """
+
+        current = self._current
+
+        for level in xrange(LEVELS):
+            shift = SLOT_BITS * level
+            slots = self._wheels[level]
+
+            for index in xrange(((current >> shift) & SLOT_MASK) + 1, SLOTS):
+                if slots[index]:
+                    block = current >> (shift + SLOT_BITS) << (shift + SLOT_BITS)
+                    return block + (index << shift)
+
+        return ((current >> (SLOT_BITS * LEVELS)) + 1) << (SLOT_BITS * LEVELS)
+
+    def _advance(self, target):
+        slots = self._wheels[0]
+
+        while self._current < target:
+            if not self._count:
+                self._current = target
+                break
+
+            tick = self._next_tick()
+
+            if tick > target:
+                self._current = target
+                break
+
+            self._current = tick
+
+            if not tick & SLOT_MASK:
+                self._cascade(1)
+
+            slot = slots[tick & SLOT_MASK]
+
+            if slot:
+                self._count -= len(slot)
+
+                for entry in slot:
+                    heapq.heappush(self._due, entry)
+
+                del slot[:]
+
+    def _cascade(self, level):
+        """Spread the timers in a level's current slot over the finer levels."""
+
+        if level < LEVELS:
+            index = (self._current >> (SLOT_BITS * level)) & SLOT_MASK
+
+            if not index:
+                self._cascade(level + 1)
+
+            slot = self._wheels[level][index]
+        else:
+            slot = self._overflow
+
+        entries = slot[:]
+        del slot[:]
+        self._count -= len(entries)
+
+        for entry in entries:
+            self._place(entry)
+
+
+class Scheduler(object):
+    """Wakes threads at the times they ask for.
+
+    A worker process shares one Scheduler among all of its WorkerBee threads.
+    The Scheduler's own thread releases a waiting thread spin seconds early,
+    and the waiting thread then busy-waits until its time arrives.
+    """
+
+    def __init__(self, spin=0, resolution=DEFAULT_RESOLUTION):
+        self._spin = spin
+        self._wheel = TimerWheel(resolution)
+        self._lock = Lock()
+
+        # When the scheduler thread will next wake on its own, or None if it
+        # will sleep until woken through the pipe.
+        self._wake_time = None
+
+        self._wake_read, self._wake_write = os.pipe()
+
+        for fd in (self._wake_read, self._wake_write):
+            flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+            fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+
+        thread = Thread(target=self._run)
+        thread.setDaemon(True)
+        thread.start()
+
+    def wait_until(self, when):
+        """Block the calling thread until time.time() >= when."""
+
+        if when - time.time() > self._spin:
+            waiter = Lock()
+            waiter.acquire()
+
+            with self._lock:
+                self._wheel.add(when, waiter)
+                wake = self._wake_time is None or when - self._spin < self._wake_time
+
+            if wake:
+                try:
+                    os.write(self._wake_write, 'x')
+                except OSError, e:
+                    if e.errno != errno.EAGAIN:
+                        raise
+
+            waiter.acquire()
+
+        spin_until(when)
+
+    def _run(self):
+        while True:
+            with self._lock:
+                for when, waiter in self._wheel.pop(time.time() + self._spin):
+                    waiter.release()
+
+                deadline = self._wheel.next_deadline()
+
+                if deadline is None:
+                    self._wake_time = None
+                    timeout = None
+                else:
+                    self._wake_time = deadline - self._spin
+                    timeout = max(0, self._wake_time - time.time())
+
+            if select.select([self._wake_read], [], [], timeout)[0]:
+                try:
+                    while os.read(self._wake_read, 4096):
+                        pass
+                except OSError, e:
+                    if e.errno != errno.EAGAIN:
+                        raise